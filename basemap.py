@@ -0,0 +1,130 @@
+import os
+import time
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import from_bounds
+
+# rasters bigger than this on a side get overviews built for them
+OVERVIEW_MIN_SIZE = 2048
+OVERVIEW_FACTORS = [2, 4, 8, 16, 32]
+
+def find_tif_files(path):
+    "GeoTIFFs at path, either a single file or all in a directory tree"
+    if os.path.isfile(path):
+        return [path]
+    tif_files = []
+    for root, dirs, files in os.walk(path):
+        for f in sorted(files):
+            if f.lower().endswith(('.tif', '.tiff')):
+                tif_files.append(os.path.join(root, f))
+    return tif_files
+
+def build_overviews(filename):
+    """
+    Write overviews for a GeoTIFF into a .ovr file beside it, leaving the
+    original untouched, so later reads of zoomed out views are cheap
+    """
+    with rasterio.Env(TIFF_USE_OVR=True):
+        with rasterio.open(filename, 'r+') as dataset:
+            factors = [f for f in OVERVIEW_FACTORS if max(dataset.width, dataset.height)//f >= 256]
+            resampling = Resampling.nearest if dataset.count==1 else Resampling.average
+            dataset.build_overviews(factors, resampling)
+
+class Basemap:
+    """
+    Mosaic of one or more GeoTIFF map tiles in a common grid (e.g. OS
+    1:25k raster tiles in OSGB), read a window at a time at the
+    resolution it will be shown at instead of loading the whole lot
+    """
+
+    def __init__(self, path, make_overviews=True):
+        self.datasets = []
+        for filename in find_tif_files(path):
+            dataset = rasterio.open(filename)
+            if make_overviews and not dataset.overviews(1) and max(dataset.width, dataset.height) > OVERVIEW_MIN_SIZE:
+                print(f'Building overviews for {filename}')
+                start_time = time.time()
+                dataset.close()
+                try:
+                    build_overviews(filename)
+                    print(f'Built overviews in {time.time()-start_time:.1f}s')
+                except Exception as e:
+                    # GDAL raises its own errors for e.g. a read-only tile or
+                    # directory, and overviews only speed things up
+                    print(f'Unable to build overviews for {filename}: {e}')
+                dataset = rasterio.open(filename)
+            self.datasets.append(dataset)
+        print(f'Found {len(self.datasets)} basemap tiles')
+        # palette lookup for single band tiles, as 256 x 3 uint8
+        self.palettes = [self._palette(d) for d in self.datasets]
+
+    @staticmethod
+    def _palette(dataset):
+        if dataset.count >= 3:
+            return None
+        try:
+            colormap = dataset.colormap(1)
+        except ValueError:
+            # no colour table, so show as grey
+            return np.repeat(np.arange(256, dtype=np.uint8)[:,None], 3, axis=1)
+        palette = np.zeros((256,3), dtype=np.uint8)
+        for idx, rgba in colormap.items():
+            if idx < 256:
+                palette[idx] = rgba[:3]
+        return palette
+
+    def extent(self):
+        "(xmin, xmax, ymin, ymax) around all tiles"
+        bounds = np.array([d.bounds for d in self.datasets])
+        return (bounds[:,0].min(), bounds[:,2].max(), bounds[:,1].min(), bounds[:,3].max())
+
+    def read(self, bounds, width, height):
+        """
+        rgba = read((xmin, xmax, ymin, ymax), width, height)
+        RGBA image of width x height pixels covering bounds, top row north,
+        transparent where there is no map.  GDAL picks the overview level
+        nearest the requested resolution.
+        """
+        xmin, xmax, ymin, ymax = bounds
+        rgba = np.zeros((height, width, 4), dtype=np.uint8)
+        x_scale = width/(xmax - xmin)
+        y_scale = height/(ymax - ymin)
+        for dataset, palette in zip(self.datasets, self.palettes):
+            left, bottom, right, top = dataset.bounds
+            # part of this tile in view
+            left, right = max(left, xmin), min(right, xmax)
+            bottom, top = max(bottom, ymin), min(top, ymax)
+            if left >= right or bottom >= top:
+                continue
+            # pixels of the output image it covers
+            col0 = int(round((left - xmin)*x_scale))
+            col1 = int(round((right - xmin)*x_scale))
+            row0 = int(round((ymax - top)*y_scale))
+            row1 = int(round((ymax - bottom)*y_scale))
+            if col1 <= col0 or row1 <= row0:
+                continue
+            window = from_bounds(left, bottom, right, top, dataset.transform)
+            if palette is None:
+                rgb = dataset.read([1,2,3], window=window, out_shape=(3, row1-row0, col1-col0),
+                                   resampling=Resampling.average)
+                rgba[row0:row1,col0:col1,:3] = np.moveaxis(rgb, 0, -1)
+            else:
+                # palette indices must not be blended
+                idx = dataset.read(1, window=window, out_shape=(row1-row0, col1-col0),
+                                   resampling=Resampling.nearest)
+                rgba[row0:row1,col0:col1,:3] = palette[idx]
+            rgba[row0:row1,col0:col1,3] = 255
+        return rgba
+
+    def close(self):
+        for dataset in self.datasets:
+            dataset.close()
+
+if __name__=='__main__':
+    import sys
+    basemap = Basemap(sys.argv[1] if len(sys.argv) > 1 else 'map_data/llanbedr_rgb.tif')
+    full_extent = basemap.extent()
+    start_time = time.time()
+    img = basemap.read(full_extent, 500, 500)
+    print(f'Read {img.shape} of {full_extent} in {time.time()-start_time:.3f}s')
@@ -0,0 +1,102 @@
+import numpy as np
+
+class RingBuffer:
+    "Fixed size history of float samples, oldest overwritten first"
+
+    def __init__(self, size):
+        self.data = np.zeros(size)
+        self.count = 0
+
+    def append(self, value):
+        "Store value and return the one it replaced, or None"
+        idx = self.count % len(self.data)
+        old = self.data[idx] if self.count >= len(self.data) else None
+        self.data[idx] = value
+        self.count += 1
+        return old
+
+    def __len__(self):
+        return min(self.count, len(self.data))
+
+class BatteryEstimator:
+    """
+    Smoothed battery and cruise speed estimates from a stream of
+    BATTERY_STATUS and GLOBAL_POSITION_INT messages.
+
+    Current is filtered with a time constant of current_tau seconds.
+    Capacity is a least squares fit of percent used against charge used
+    over the last history_size battery messages, and cruise speed the
+    mean of the last history_size ground speeds above min_cruise_speed.
+    Both keep running sums alongside their ring buffers, so every update
+    is O(1) however long the flight.
+    """
+
+    def __init__(self, history_size=300, current_tau=30.0, min_cruise_speed=2.0):
+        self.current_tau = current_tau
+        self.min_cruise_speed = min_cruise_speed
+        self.consumed = RingBuffer(history_size)
+        self.percent_used = RingBuffer(history_size)
+        self.speeds = RingBuffer(history_size)
+        # running sums for the capacity fit and mean speed
+        self.sum_cc = 0.0
+        self.sum_cp = 0.0
+        self.sum_speed = 0.0
+        self.smoothed_current = None
+        self.last_time = None
+
+    def update_battery(self, msg, now):
+        "Add a BATTERY_STATUS message received at time now"
+        current = msg.current_battery*10.0  # to mA
+        if current < 0:
+            # current not measured
+            return
+        if self.smoothed_current is None:
+            self.smoothed_current = current
+        else:
+            alpha = 1.0 - np.exp(-max(now - self.last_time, 0.0)/self.current_tau)
+            self.smoothed_current += alpha*(current - self.smoothed_current)
+        self.last_time = now
+        if msg.battery_remaining < 0 or msg.current_consumed < 0:
+            return
+        consumed = float(msg.current_consumed)
+        percent_used = 100.0 - msg.battery_remaining
+        old_consumed = self.consumed.append(consumed)
+        old_percent = self.percent_used.append(percent_used)
+        if old_consumed is not None:
+            self.sum_cc -= old_consumed*old_consumed
+            self.sum_cp -= old_consumed*old_percent
+        self.sum_cc += consumed*consumed
+        self.sum_cp += consumed*percent_used
+
+    def update_position(self, msg):
+        "Add a GLOBAL_POSITION_INT message"
+        ground_speed = np.hypot(msg.vx, msg.vy)*0.01  # to m/s
+        if ground_speed < self.min_cruise_speed:
+            # hovering or on the ground
+            return
+        old_speed = self.speeds.append(ground_speed)
+        if old_speed is not None:
+            self.sum_speed -= old_speed
+        self.sum_speed += ground_speed
+
+    def capacity(self):
+        "Estimated full capacity in mAh, or None until the battery has been used"
+        if self.sum_cp <= 0.0:
+            return None
+        # percent_used = 100*consumed/capacity, fitted through the origin
+        return 100.0*self.sum_cc/self.sum_cp
+
+    def cruise_speed(self):
+        "Mean ground speed in m/s when moving, or None"
+        if len(self.speeds)==0:
+            return None
+        return self.sum_speed/len(self.speeds)
+
+    def time_remaining(self, target_percent):
+        "Seconds until target_percent of capacity is left, at the smoothed current"
+        capacity = self.capacity()
+        if capacity is None or not self.smoothed_current or len(self.consumed)==0:
+            return None
+        latest = (self.consumed.count - 1) % len(self.consumed.data)
+        charge_over_target = capacity*(1.0 - 0.01*target_percent) - self.consumed.data[latest]
+        return 3600.0*charge_over_target/self.smoothed_current
@@ -0,0 +1,219 @@
+import os
+import time
+import json
+import uuid
+import tempfile
+import argparse
+import threading
+import logging
+import numpy as np
+import requests
+import urllib3
+from chat_client import ChatClient
+
+def start_local_server(db_path, port, serve='production', threads=64, tls=False):
+    """
+    url, stop = start_local_server(db_path, port)
+    Run chat_server on a thread, under cheroot as in production or the
+    Flask development server, over HTTPS with the server's certificate
+    if tls is set or plain HTTP if not
+    """
+    import chat_server
+    chat_server.init_store(db_path)
+    ssl_files = chat_server.get_certificate() if tls else None
+    scheme = 'https' if tls else 'http'
+    if serve=='production':
+        server = chat_server.make_production_server('127.0.0.1', port, threads, ssl_files=ssl_files)
+        server.prepare()
+        threading.Thread(target=server.serve, daemon=True).start()
+        return f'{scheme}://127.0.0.1:{server.bind_addr[1]}', lambda: chat_server.stop_production_server(server)
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', port, chat_server.app, threaded=True, ssl_context=ssl_files)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'{scheme}://127.0.0.1:{server.server_port}', server.shutdown
+
+class BenchSender:
+    """
+    Posts located messages at a steady rate, or flat out if rate is 0.
+    A post that times out may still have been stored, so its sequence
+    number is kept in timed_out rather than counted as lost.
+    """
+
+    def __init__(self, url, index, run_id, rate, timeout=30.0):
+        self.client = ChatClient(url)
+        self.index = index
+        self.run_id = run_id
+        self.rate = rate
+        self.timeout = timeout
+        self.sent = set()
+        self.timed_out = set()
+        self.post_times = []
+        self.errors = 0
+
+    def run(self, end_time):
+        next_time = time.time()
+        seq = 0
+        while time.time() < end_time:
+            if self.rate > 0:
+                time.sleep(max(next_time - time.time(), 0.0))
+                next_time += 1.0/self.rate
+            send_time = time.time()
+            # everything the readers need to score the message is in the text
+            text = f'{self.run_id} {self.index} {seq} {send_time:.6f}'
+            try:
+                status = self.client.send_message(f'Bench {self.index}', text,
+                                                  (52.8 + 0.001*self.index, -4.1),
+                                                  timeout=self.timeout)
+            except requests.Timeout:
+                status = 'timeout'
+            except requests.RequestException:
+                status = None
+            if status==200:
+                self.sent.add((self.index, seq))
+                self.post_times.append(time.time() - send_time)
+            elif status=='timeout':
+                self.timed_out.add((self.index, seq))
+            else:
+                self.errors += 1
+            seq += 1
+
+class BenchReader:
+    "Map console receiving by stream, longpoll or poll, timing each arrival"
+
+    def __init__(self, url, run_id, mode, start_id):
+        self.client = ChatClient(url)
+        self.client.last_id = start_id
+        self.run_id = run_id
+        self.mode = mode
+        # set once the senders are done
+        self.end_time = float('inf')
+        self.received = set()
+        self.latencies = []
+        self.errors = 0
+
+    def receive(self, msg):
+        fields = msg.text.split()
+        if len(fields)==4 and fields[0]==self.run_id:
+            self.received.add((int(fields[1]), int(fields[2])))
+            self.latencies.append(time.time() - float(fields[3]))
+
+    def run(self):
+        while time.time() < self.end_time:
+            try:
+                if self.mode=='stream':
+                    for msg in self.client.stream_messages():
+                        self.receive(msg)
+                        if time.time() > self.end_time:
+                            return
+                elif self.mode=='longpoll':
+                    for msg in self.client.get_new_messages(wait=1.0):
+                        self.receive(msg)
+                else:
+                    for msg in self.client.get_new_messages():
+                        self.receive(msg)
+                    time.sleep(0.5)
+            except (requests.RequestException, ValueError):
+                self.errors += 1
+                time.sleep(0.1)
+
+def percentiles_ms(values):
+    if not values:
+        return 'n/a'
+    p50, p99 = np.percentile(values, [50, 99])*1000.0
+    return f'p50 {p50:.1f}ms p99 {p99:.1f}ms'
+
+def benchmark(url, num_senders, num_readers, duration, rate, mode, drain=3.0, timeout=30.0):
+    run_id = uuid.uuid4().hex[:8]
+    # readers only want this run's messages
+    if url.startswith('https'):
+        # the chat server certificate is self-signed
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    start_client = ChatClient(url)
+    recent = json.loads(start_client.session.get(url.rstrip('/')+'/monitor/',
+                                                 params={'limit': 1}, timeout=5.0).content)
+    start_id = recent[-1]['id'] if recent else 0
+    senders = [BenchSender(url, ii, run_id, rate, timeout) for ii in range(num_senders)]
+    readers = [BenchReader(url, run_id, mode, start_id) for ii in range(num_readers)]
+    start_time = time.time()
+    send_end = start_time + duration
+    reader_threads = [threading.Thread(target=r.run, daemon=True) for r in readers]
+    sender_threads = [threading.Thread(target=s.run, args=(send_end,), daemon=True) for s in senders]
+    for thread in reader_threads + sender_threads:
+        thread.start()
+    # a post in progress at the end can take up to the timeout
+    for thread in sender_threads:
+        thread.join()
+    for reader in readers:
+        reader.end_time = time.time() + drain
+    # a stream reader can sit in a read past the end, so give up on it
+    deadline = time.time() + drain + 1.0
+    for thread in reader_threads:
+        thread.join(max(deadline - time.time(), 0.0))
+    sent = set().union(*(s.sent for s in senders))
+    post_times = sum((s.post_times for s in senders), [])
+    timed_out = set().union(*(s.timed_out for s in senders))
+    # copies, as a reader left behind may still be adding
+    received = [r.received.copy() for r in readers]
+    latencies = sum((list(r.latencies) for r in readers), [])
+    # loss only counts posts the server confirmed
+    missing = sum(len(sent - r) for r in received)
+    # timed out posts that were stored anyway, or anything else unexplained
+    unexpected = sum(len(r - sent) for r in received)
+    print(f'{num_senders} senders, {num_readers} {mode} readers, {duration:.0f}s')
+    print(f'Sent {len(sent)} messages, {len(sent)/duration:.1f} msgs/s, '
+          f'{sum(s.errors for s in senders)} send errors, {len(timed_out)} timed out')
+    print(f'Post round trip: {percentiles_ms(post_times)}')
+    print(f'Delivery: {percentiles_ms(latencies)}, '
+          f'{len(latencies)/duration:.1f} deliveries/s, '
+          f'{sum(r.errors for r in readers)} reader errors')
+    if readers and sent:
+        print(f'Lost {missing} of {len(sent)*len(readers)} deliveries '
+              f'({100.0*missing/(len(sent)*len(readers)):.2f}%)')
+    if unexpected:
+        print(f'{unexpected} deliveries of unconfirmed messages, '
+              f'{len(timed_out)*len(readers)} possible from timed out posts')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u','--url',
+                        help='Chat server to test, default starts a local one on a fresh database',
+                        default=None)
+    parser.add_argument('-n','--senders', type=int, default=20,
+                        help='Number of phones sending messages')
+    parser.add_argument('-m','--readers', type=int, default=2,
+                        help='Number of map consoles reading')
+    parser.add_argument('-d','--duration', type=float, default=10.0,
+                        help='Seconds to send for')
+    parser.add_argument('-r','--rate', type=float, default=1.0,
+                        help='Messages per second from each sender, 0 for flat out')
+    parser.add_argument('--mode', choices=['stream','longpoll','poll'], default='stream',
+                        help='How readers receive messages')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Seconds a sender waits for each post before giving up')
+    parser.add_argument('--port', type=int, default=0,
+                        help='Port for the local server, 0 for any free one')
+    parser.add_argument('--serve', choices=['production','dev'], default='production',
+                        help='Run the local server under cheroot or the Flask development server')
+    parser.add_argument('--threads', type=int, default=64,
+                        help='Threads for the local production server')
+    parser.add_argument('--tls', action='store_true',
+                        help='Serve the local server over HTTPS with the chat server certificate, as deployed')
+    args = parser.parse_args()
+    url = args.url
+    stop_server = None
+    if url is None:
+        db_dir = tempfile.mkdtemp()
+        url, stop_server = start_local_server(os.path.join(db_dir, 'bench.db'), args.port,
+                                              args.serve, args.threads, args.tls)
+        print(f'Local {args.serve} server at {url}')
+    try:
+        benchmark(url, args.senders, args.readers, args.duration, args.rate, args.mode,
+                  timeout=args.timeout)
+    finally:
+        # the server's worker threads would otherwise keep the process alive
+        if stop_server:
+            stop_server()
+
+if __name__=='__main__':
+    main()
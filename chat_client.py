@@ -1,5 +1,8 @@
 import requests
 import json
+import time
+import queue
+import threading
 import warnings
 from datetime import datetime
 import argparse
@@ -16,6 +19,7 @@ def make_qr_code():
 class ChatMessage:
 
     def __init__(self, sender=None, text=None, time=None, lat=None, lon=None, input_dict=None):
+        self.msg_id = None
         self.sender = sender
         self.text = text
         self.time = time
@@ -25,6 +29,7 @@ class ChatMessage:
             self.load_dict(input_dict)
 
     def load_dict(self,input_dict):
+        self.msg_id = input_dict.get('id')
         self.sender = input_dict['name']
         self.text = input_dict['msg']
         self.time = datetime.fromisoformat(input_dict['time'])
@@ -50,32 +55,149 @@ class ChatClient:
         self.base_url = base_url
         if not self.base_url.endswith('/'):
             self.base_url += '/'
+        # ID of the newest message seen, so each fetch gets only newer ones
+        self.last_id = 0
+        # keep connections open rather than a new TLS handshake per request
+        self.session = requests.Session()
+        self.session.verify = False
 
-    def get_new_messages(self):
+    def get_new_messages(self, wait=None):
+        "Messages since the last call, waiting up to wait seconds for one if given"
         messages = []
+        params = {'since': self.last_id}
+        timeout = 1.0
+        if wait:
+            # long-poll, the server holds on until there is news
+            params['wait'] = wait
+            timeout += wait
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            chat_inbox_req = requests.get(self.base_url+'inbox', verify=False, timeout=1.0)
+            chat_inbox_req = self.session.get(self.base_url+'inbox/', params=params, timeout=timeout)
+        chat_inbox_req.raise_for_status()
         chat_inbox = json.loads(chat_inbox_req.content)
         for chat_dict in chat_inbox:
             messages.append(ChatMessage(input_dict=chat_dict))
             #print(messages)
+        if messages:
+            self.last_id = max(self.last_id, messages[-1].msg_id)
         return messages
 
-    def send_message(self, sender, message, position):
+    def stream_messages(self, keepalive=15.0):
+        """
+        Generator of messages pushed by the server as server-sent events,
+        starting after the last one seen.  Ends if the connection drops,
+        or nothing, not even a keepalive, arrives for twice keepalive.
+        """
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            chat_post_response = requests.post(self.base_url+'chat', verify=False, timeout=1.0,
-                                                data={'name': sender,
-                                                        'msg': message,
-                                                        'lat': position[0],
-                                                        'lon': position[1]})
-        print(chat_post_response.status_code)
+            stream_req = self.session.get(self.base_url+'stream/', params={'since': self.last_id},
+                                          stream=True, timeout=(5.0, 2*keepalive))
+        with stream_req:
+            stream_req.raise_for_status()
+            data_lines = []
+            # chunk_size 1 so each event is handed over as soon as it lands
+            for line in stream_req.iter_lines(chunk_size=1, decode_unicode=True):
+                if line.startswith('data:'):
+                    data_lines.append(line[5:].lstrip())
+                elif not line and data_lines:
+                    # blank line ends an event
+                    msg = ChatMessage(input_dict=json.loads('\n'.join(data_lines)))
+                    data_lines = []
+                    self.last_id = max(self.last_id, msg.msg_id)
+                    yield msg
+
+    def send_message(self, sender, message, position, timeout=1.0):
+        "Post a message and return the HTTP status code, waiting up to timeout s"
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            chat_post_response = self.session.post(self.base_url+'chat/', timeout=timeout,
+                                                   data={'name': sender,
+                                                         'msg': message,
+                                                         'lat': position[0],
+                                                         'lon': position[1]})
+        return chat_post_response.status_code
+
+class ChatWorker:
+    """
+    Fetches chat on a background thread so a slow or missing server never
+    holds up the caller, which collects parsed messages with get_batch().
+    mode is 'stream', 'longpoll' or 'poll'.  After a failure it waits
+    before trying again, doubling the wait each time up to max_backoff.
+    """
+
+    def __init__(self, client, mode='stream', poll_period=0.5, max_backoff=30.0):
+        self.client = client
+        self.mode = mode
+        self.poll_period = poll_period
+        self.max_backoff = max_backoff
+        self.messages = queue.Queue()
+        self.connected = False
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # a stream blocked in a read is left to die with the process
+        self._running = False
+
+    def get_batch(self, max_messages=50):
+        "Up to max_messages queued messages, without waiting"
+        batch = []
+        while len(batch) < max_messages:
+            try:
+                batch.append(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _fetch(self):
+        if self.mode=='stream':
+            for msg in self.client.stream_messages():
+                self._got_message(msg)
+                if not self._running:
+                    return
+        elif self.mode=='longpoll':
+            for msg in self.client.get_new_messages(wait=25.0):
+                self._got_message(msg)
+        else:
+            for msg in self.client.get_new_messages():
+                self._got_message(msg)
+            time.sleep(self.poll_period)
+        self._set_connected(True)
+
+    def _got_message(self, msg):
+        self._set_connected(True)
+        self.messages.put(msg)
+
+    def _set_connected(self, connected):
+        if connected!=self.connected:
+            print('Chat server connected' if connected else 'Chat server lost')
+            self.connected = connected
+
+    def _run(self):
+        backoff = 1.0
+        while self._running:
+            try:
+                self._fetch()
+                backoff = 1.0
+            except (requests.RequestException, ValueError, KeyError) as e:
+                if self.connected:
+                    print(f'Chat error: {e}')
+                self._set_connected(False)
+                time.sleep(backoff)
+                backoff = min(2.0*backoff, self.max_backoff)
 
 def test_client():
     parser = argparse.ArgumentParser()
     parser.add_argument('-u','--url',default='https://127.0.0.1:5000')
     parser.add_argument('-r','--read',action='store_true')
+    parser.add_argument('-w','--watch',action='store_true',
+                        help='Print messages as the server pushes them')
     parser.add_argument('-s','--sender', default='Test client')
     parser.add_argument('-m','--message', default='Test message')
     parser.add_argument('-p','--position', nargs=2, default=[52.8,-4.1])
@@ -85,14 +207,19 @@ def test_client():
     if args.qrcode:
         print('Saving QR code')
         make_qr_code()
-    if args.read:
+    if args.watch:
+        print('Watching for messages')
+        while True:
+            for msg in client.stream_messages():
+                print(msg)
+    elif args.read:
         print('Checking inbox')
         print(client.get_new_messages())
     else:
         print(f'Sending {args.message} as {args.sender} at {args.position}')
-        client.send_message(args.sender,
-                            args.message,
-                            args.position)
+        print(client.send_message(args.sender,
+                                  args.message,
+                                  args.position))
 
 if __name__=='__main__':
     test_client()
\ No newline at end of file
@@ -1,10 +1,47 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request
 from datetime import datetime
+import os
+import time
 import json
+import argparse
+import threading
+from message_store import MessageStore
 
 app = Flask(__name__)
 
-msgs = []
+# opened by init_store, or on first use from CHAT_DB by any WSGI server
+store = None
+store_lock = threading.Lock()
+default_db = 'chat_messages.db'
+# set to end open streams so the server can stop
+streams_closing = threading.Event()
+
+# most messages sent in one response
+max_page = 200
+# longest a long-poll is held open, and how often an idle stream is
+# sent a comment to keep proxies and NAT from dropping it, in s
+max_wait = 30.0
+stream_keepalive = 15.0
+# certificate kept between runs, so phones only have to accept it once
+cert_base = 'chat_cert'
+
+def init_store(db_path):
+    global store
+    store = MessageStore(db_path)
+
+def get_store():
+    "The message store, opening CHAT_DB (default chat_messages.db) if not yet set up"
+    with store_lock:
+        if store is None:
+            init_store(os.environ.get('CHAT_DB', default_db))
+    return store
+
+def parse_coord(value):
+    "Form value as a float, or None if the sender was not located"
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
 @app.route("/")
 def home():
@@ -16,12 +53,11 @@ def chat():
         sender_name = request.form['name']
         msg_time = datetime.now().isoformat()
         msg_text = request.form['msg']
-        msgs.append({'name': sender_name,
-                     'time': msg_time,
-                     'msg': msg_text,
-                     'lat': request.form['lat'],
-                     'lon': request.form['lon'],
-                     })
+        get_store().add(sender_name,
+                  msg_time,
+                  msg_text,
+                  parse_coord(request.form.get('lat')),
+                  parse_coord(request.form.get('lon')))
         summary = f'Received "{msg_text}" from {sender_name} at time {msg_time}'
         return render_template('chat.html', name=sender_name, recv=summary)
     else:
@@ -29,15 +65,106 @@ def chat():
 
 @app.route("/monitor/")
 def monitor():
-    return json.dumps(msgs)
+    # SQLite takes a negative LIMIT as no limit
+    limit = max(1, min(request.args.get('limit', 100, type=int), max_page))
+    return json.dumps(get_store().recent(limit))
 
 @app.route("/inbox/")
 def inbox():
-    received_msgs = []
-    num_msgs = len(msgs)
-    for ii in range(num_msgs):
-        received_msgs.append(msgs.pop(0))
-    return json.dumps(received_msgs)
+    # each console asks for what came after the last ID it saw
+    since = request.args.get('since', 0, type=int)
+    # long-poll: hold the request until there is something new
+    wait = min(request.args.get('wait', 0.0, type=float), max_wait)
+    if wait > 0:
+        return json.dumps(get_store().wait_for(since, wait, max_page))
+    return json.dumps(get_store().since(since, max_page))
+
+@app.route("/stream/")
+def stream():
+    "Server-sent events, one per message, from after since or Last-Event-ID"
+    since = request.args.get('since', 0, type=int)
+    # a reconnecting browser says where it got to
+    since = request.headers.get('Last-Event-ID', since, type=int)
+    message_store = get_store()
+    def events(last_id):
+        # open the stream straight away so the client knows it is connected
+        yield ': connected\n\n'
+        last_sent = time.time()
+        while not streams_closing.is_set():
+            # short waits so a closing server is noticed
+            messages = message_store.wait_for(last_id, 1.0, max_page)
+            if messages:
+                last_sent = time.time()
+            elif time.time() > last_sent + stream_keepalive:
+                last_sent = time.time()
+                yield ': keepalive\n\n'
+            for msg in messages:
+                last_id = msg['id']
+                yield f'id: {last_id}\ndata: {json.dumps(msg)}\n\n'
+    return Response(events(since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+def get_certificate(base_path=cert_base):
+    "(cert, key) files, making a self-signed pair the first time"
+    cert_file, key_file = base_path + '.crt', base_path + '.key'
+    if not (os.path.exists(cert_file) and os.path.exists(key_file)):
+        from werkzeug.serving import make_ssl_devcert
+        print(f'Making self-signed certificate {cert_file}')
+        make_ssl_devcert(base_path)
+    return cert_file, key_file
+
+def make_production_server(host, port, threads=64, keepalive=30, ssl_files=None):
+    """
+    Threaded cheroot WSGI server for the app.  Idle keep-alive connections
+    wait without a thread, so threads only limits requests in progress,
+    including open streams and long-polls.
+    """
+    from cheroot import wsgi
+    server = wsgi.Server((host, port), app,
+                         numthreads=threads,
+                         request_queue_size=256,
+                         timeout=keepalive)
+    if ssl_files:
+        from cheroot.ssl.builtin import BuiltinSSLAdapter
+        server.ssl_adapter = BuiltinSSLAdapter(*ssl_files)
+    return server
+
+def stop_production_server(server):
+    # threads serving streams only finish once the streams end
+    streams_closing.set()
+    server.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db',
+                        help='SQLite file to keep messages in',
+                        default=default_db)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--dev', action='store_true',
+                        help='Use the Flask development server')
+    parser.add_argument('--threads', type=int, default=64,
+                        help='Requests handled at once, each open stream or long-poll takes one')
+    parser.add_argument('--no_tls', action='store_true',
+                        help='Serve plain HTTP, e.g. behind a proxy or for testing')
+    args = parser.parse_args()
+    init_store(args.db)
+    ssl_files = None if args.no_tls else get_certificate()
+    if args.dev:
+        app.run(ssl_context=ssl_files, host=args.host, port=args.port, threaded=True)
+        return
+    try:
+        server = make_production_server(args.host, args.port, args.threads, ssl_files=ssl_files)
+    except ImportError:
+        print('cheroot not installed, using the Flask development server')
+        app.run(ssl_context=ssl_files, host=args.host, port=args.port, threaded=True)
+        return
+    scheme = 'http' if args.no_tls else 'https'
+    print(f'Serving on {scheme}://{args.host}:{args.port} with {args.threads} threads')
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        stop_production_server(server)
 
 if __name__ == "__main__":
-    app.run(ssl_context='adhoc', host='0.0.0.0')
\ No newline at end of file
+    main()
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+import numpy as np
+
+class CoordTransform:
+    """
+    GPS lat/lon to and from OSGB eastings/northings.
+
+    The pyproj transformers are only built on first use.  Arrays of points
+    go through pyproj in one call, and recent results are cached so
+    repeated positions, like a parked takeoff point or a chat sender who
+    has not moved, cost a dictionary lookup.  Cache keys are rounded to
+    1e-7 deg, the resolution of MAVLink positions, or 1cm.
+    """
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self._to_east_north = None
+        self._to_lat_lon = None
+        self.east_north_cache = OrderedDict()
+        self.lat_lon_cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _transformer(self, to_east_north):
+        if self._to_east_north is None:
+            import pyproj
+            crs_osgb = pyproj.CRS.from_epsg(27700)
+            crs_gps = pyproj.CRS.from_epsg(4326)
+            self._to_east_north = pyproj.Transformer.from_crs(crs_gps, crs_osgb)
+            self._to_lat_lon = pyproj.Transformer.from_crs(crs_osgb, crs_gps)
+        return self._to_east_north if to_east_north else self._to_lat_lon
+
+    def to_east_north(self, lat, lon):
+        "x,y = to_east_north(lat, lon) for scalars or arrays"
+        return self._transform(lat, lon, 1.0e7, self.east_north_cache, True)
+
+    def to_lat_lon(self, x, y):
+        "lat,lon = to_lat_lon(x, y) for scalars or arrays"
+        return self._transform(x, y, 100.0, self.lat_lon_cache, False)
+
+    def _transform(self, a, b, key_scale, cache, to_east_north):
+        a_arr = np.atleast_1d(np.asarray(a, dtype=float))
+        b_arr = np.atleast_1d(np.asarray(b, dtype=float))
+        out = np.empty((2, len(a_arr)))
+        keys = list(zip(np.rint(a_arr*key_scale).astype(np.int64).tolist(),
+                        np.rint(b_arr*key_scale).astype(np.int64).tolist()))
+        misses = []
+        for ii, key in enumerate(keys):
+            result = cache.get(key)
+            if result is None:
+                misses.append(ii)
+            else:
+                cache.move_to_end(key)
+                out[:,ii] = result
+        self.hits += len(keys) - len(misses)
+        self.misses += len(misses)
+        if misses:
+            # all the new points in one call
+            out[0,misses], out[1,misses] = self._transformer(to_east_north).transform(a_arr[misses], b_arr[misses])
+            for ii in misses:
+                cache[keys[ii]] = (out[0,ii], out[1,ii])
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        if np.ndim(a)==0:
+            return out[0,0], out[1,0]
+        return out[0], out[1]
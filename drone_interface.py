@@ -1,158 +1,374 @@
 import time
+import threading
 from pymavlink import mavutil
+from telemetry_log import TelemetryRecorder, TelemetryReplay
+from battery_estimator import BatteryEstimator
+
+MAVLINK_TYPES = ['HEARTBEAT',
+                 'GLOBAL_POSITION_INT',
+                 'BATTERY_STATUS']
+
+class VehicleState:
+    "Latest known state of one vehicle on the link"
+
+    __slots__ = ('system_id', 'component_id', 'last_msg_dict',
+                 'takeoff_pos_msg', 'takeoff_time', 'target',
+                 'target_changed_at', 'target_sent_at', 'battery')
+
+    def __init__(self, system_id, component_id):
+        self.system_id = system_id
+        self.component_id = component_id
+        self.last_msg_dict = {}
+        self.takeoff_pos_msg = None
+        self.takeoff_time = None
+        self.target = None
+        # time of a change not yet sent, and of the last send
+        self.target_changed_at = None
+        self.target_sent_at = None
+        self.battery = BatteryEstimator()
+
+    def target_due_at(self, coalesce_period, keepalive_period):
+        "Time the target should next be sent, or None if there is none"
+        if self.target is None:
+            return None
+        if self.target_sent_at is None:
+            return self.target_changed_at
+        if self.target_changed_at is not None:
+            # changes go at once, but no faster than the coalescing period
+            return max(self.target_changed_at, self.target_sent_at + coalesce_period)
+        return self.target_sent_at + keepalive_period
 
 class DroneInterface:
 
-    def __init__(self,mav_connect_str):
+    def __init__(self,mav_connect_str,log_file=None,keepalive_period=2.0,coalesce_period=0.1):
         self.connected = False
         self.mav_connection = None
         if mav_connect_str:
             print(f'Connecting to {mav_connect_str}')
             try:
-                self.mav_connection = mavutil.mavlink_connection(mav_connect_str)
+                if mav_connect_str.startswith('replay:'):
+                    self.mav_connection = TelemetryReplay.from_connect_string(mav_connect_str)
+                else:
+                    self.mav_connection = mavutil.mavlink_connection(mav_connect_str)
                 print(f'Connected to {mav_connect_str}')
                 self.connected = True
             except ConnectionError:
                 print(f'Failed to connect to {mav_connect_str}')
                 self.mav_connection = None
+        # first vehicle seen is the default for all queries
         self.drone_id = None
-        self.drone_target = None
-        self.takeoff_pos_msg = None
-        self.takeoff_time = None
-        self.last_msg_dict = {}
+        self.vehicles = {}
+        # reader thread writes state, GUI thread reads it
+        self._state_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = None
+        self._running = False
+        self.message_count = 0
+        # targets are sent by the command thread when changed, then kept alive
+        self.keepalive_period = keepalive_period
+        self.coalesce_period = coalesce_period
+        self._command_cond = threading.Condition()
+        self._commander = None
+        self.command_stats = {'start_time': time.time(),
+                              'messages': 0,
+                              'bytes': 0,
+                              'changes': 0,
+                              'latency_total': 0.0,
+                              'latency_max': 0.0}
+        # everything received is logged if asked
+        self.recorder = None
+        if log_file and self.connected:
+            print(f'Recording telemetry to {log_file}')
+            self.recorder = TelemetryRecorder(log_file)
+
+    def start(self):
+        "Receive MAVLink and send targets on background threads from now on"
+        if self.connected and self._reader is None:
+            self._running = True
+            self._reader = threading.Thread(target=self._read_loop, daemon=True)
+            self._reader.start()
+            self._commander = threading.Thread(target=self._command_loop, daemon=True)
+            self._commander.start()
+
+    def stop(self):
+        self._running = False
+        with self._command_cond:
+            self._command_cond.notify()
+        if self._reader:
+            self._reader.join()
+            self._reader = None
+        if self._commander:
+            self._commander.join()
+            self._commander = None
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def _read_loop(self):
+        while self._running:
+            # blocks on the link, so an idle link costs nothing
+            msg = self.mav_connection.recv_match(blocking=True, timeout=0.5)
+            if msg:
+                self.handle_message(msg)
+
+    def handle_message(self,msg):
+        "Record any message, then process those of interest"
+        self.message_count += 1
+        if self.recorder:
+            self.recorder.record(msg)
+        if msg.get_type() in MAVLINK_TYPES:
+            self.process_message(msg)
+
+    def vehicle_ids(self):
+        "System IDs of all vehicles heard, in order of first contact"
+        with self._state_lock:
+            return list(self.vehicles)
 
-    def set_target(self,lat,lon,asl,yaw_rate):
-        self.drone_target = (lat, lon, asl, yaw_rate)
+    def vehicle(self,system_id=None):
+        "VehicleState for system_id, default the first vehicle, or None"
+        if system_id is None:
+            system_id = self.drone_id
+        return self.vehicles.get(system_id)
 
-    def get_target(self):
-        return self.drone_target
+    def set_target(self,lat,lon,asl,yaw_rate,system_id=None):
+        vehicle = self.vehicle(system_id)
+        if vehicle:
+            new_target = (lat, lon, asl, yaw_rate)
+            if None in new_target:
+                # the command thread would fail packing it, so never store it
+                print(f'Ignoring incomplete target {new_target}')
+                return
+            with self._command_cond:
+                if new_target != vehicle.target:
+                    vehicle.target = new_target
+                    # keep the time of the first unsent change for latency
+                    if vehicle.target_changed_at is None:
+                        vehicle.target_changed_at = time.time()
+                    self._command_cond.notify()
 
-    def clear_target(self):
-        self.drone_target = None
+    def get_target(self,system_id=None):
+        vehicle = self.vehicle(system_id)
+        if vehicle:
+            return vehicle.target
+
+    def clear_target(self,system_id=None):
+        vehicle = self.vehicle(system_id)
+        if vehicle:
+            with self._command_cond:
+                vehicle.target = None
+                vehicle.target_changed_at = None
 
     def send_target(self):
-        if self.drone_target:
-            self.mav_connection.mav.set_position_target_global_int_send(
-                0,  # timestamp
-                self.drone_id,  # target system_id
-                1,  # target component id
-                mavutil.mavlink.MAV_FRAME_GLOBAL_INT,  # mavutil.mavlink.MAV_FRAME_GLOBAL_INT,
-                mavutil.mavlink.POSITION_TARGET_TYPEMASK_VX_IGNORE |
-                mavutil.mavlink.POSITION_TARGET_TYPEMASK_VY_IGNORE |
-                mavutil.mavlink.POSITION_TARGET_TYPEMASK_VZ_IGNORE |
-                mavutil.mavlink.POSITION_TARGET_TYPEMASK_AX_IGNORE |
-                mavutil.mavlink.POSITION_TARGET_TYPEMASK_AY_IGNORE |
-                mavutil.mavlink.POSITION_TARGET_TYPEMASK_AZ_IGNORE |
-                mavutil.mavlink.POSITION_TARGET_TYPEMASK_YAW_IGNORE,
-                int(self.drone_target[0] * 1.0e7),  # lat
-                int(self.drone_target[1] * 1.0e7),  # lon
-                self.drone_target[2],  # alt rel home
-                0,  # vx
-                0,  # vy
-                0,  # vz
-                0,  # afx
-                0,  # afy
-                0,  # afz
-                0,  # yaw
-                self.drone_target[3],  # yawrate
-            )
+        "Send the current target of every vehicle that has one"
+        with self._command_cond:
+            for vehicle in list(self.vehicles.values()):
+                if vehicle.target:
+                    self._send_target(vehicle)
+
+    def _command_loop(self):
+        with self._command_cond:
+            while self._running:
+                now = time.time()
+                next_due = None
+                for vehicle in list(self.vehicles.values()):
+                    due = vehicle.target_due_at(self.coalesce_period, self.keepalive_period)
+                    if due is None:
+                        continue
+                    if due <= now:
+                        try:
+                            self._send_target(vehicle)
+                        except Exception as e:
+                            # keep sending to the other vehicles, retried at the keepalive
+                            print(f'Failed to send target to vehicle {vehicle.system_id}: {e!r}')
+                        due = vehicle.target_due_at(self.coalesce_period, self.keepalive_period)
+                    if next_due is None or due < next_due:
+                        next_due = due
+                # sleep until the next send or a new target
+                self._command_cond.wait(None if next_due is None else max(next_due - time.time(), 0.0))
+
+    def command_report(self):
+        "Summary of target sending since start"
+        stats = self.command_stats
+        elapsed = max(time.time() - stats['start_time'], 1e-9)
+        mean_latency = stats['latency_total']/stats['changes'] if stats['changes'] else 0.0
+        return (f"{stats['messages']} targets sent, {stats['bytes']/elapsed:.1f} bytes/s, "
+                f"{stats['changes']} changes, latency mean {mean_latency*1000:.0f}ms "
+                f"max {stats['latency_max']*1000:.0f}ms")
+
+    def _send_target(self,vehicle):
+        now = time.time()
+        if vehicle.target_changed_at is not None:
+            latency = now - vehicle.target_changed_at
+            self.command_stats['changes'] += 1
+            self.command_stats['latency_total'] += latency
+            self.command_stats['latency_max'] = max(self.command_stats['latency_max'], latency)
+        vehicle.target_changed_at = None
+        vehicle.target_sent_at = now
+        with self._send_lock:
+            msg = self._target_message(vehicle)
+            self.mav_connection.mav.send(msg)
+        self.command_stats['messages'] += 1
+        self.command_stats['bytes'] += len(msg.get_msgbuf())
+
+    def _target_message(self,vehicle):
+        return self.mav_connection.mav.set_position_target_global_int_encode(
+            0,  # timestamp
+            vehicle.system_id,  # target system_id
+            1,  # target component id
+            mavutil.mavlink.MAV_FRAME_GLOBAL_INT,  # mavutil.mavlink.MAV_FRAME_GLOBAL_INT,
+            mavutil.mavlink.POSITION_TARGET_TYPEMASK_VX_IGNORE |
+            mavutil.mavlink.POSITION_TARGET_TYPEMASK_VY_IGNORE |
+            mavutil.mavlink.POSITION_TARGET_TYPEMASK_VZ_IGNORE |
+            mavutil.mavlink.POSITION_TARGET_TYPEMASK_AX_IGNORE |
+            mavutil.mavlink.POSITION_TARGET_TYPEMASK_AY_IGNORE |
+            mavutil.mavlink.POSITION_TARGET_TYPEMASK_AZ_IGNORE |
+            mavutil.mavlink.POSITION_TARGET_TYPEMASK_YAW_IGNORE,
+            int(vehicle.target[0] * 1.0e7),  # lat
+            int(vehicle.target[1] * 1.0e7),  # lon
+            vehicle.target[2],  # alt rel home
+            0,  # vx
+            0,  # vy
+            0,  # vz
+            0,  # afx
+            0,  # afy
+            0,  # afz
+            0,  # yaw
+            vehicle.target[3],  # yawrate
+        )
 
     def process_mavlink(self):
-        msg = self.mav_connection.recv_match(type=['HEARTBEAT',
-                                                   'GLOBAL_POSITION_INT',
-                                                   'BATTERY_STATUS'
-                                                  ], blocking=False)
-        if msg:
-            if self.drone_id is None:
-                self.drone_id = msg.get_srcSystem()
-                # request data
-                self.mav_connection.mav.request_data_stream_send(msg.get_srcSystem(),
+        "Handle every message already waiting, without blocking"
+        while True:
+            msg = self.mav_connection.recv_match(blocking=False)
+            if not msg:
+                break
+            self.handle_message(msg)
+
+    def process_message(self,msg):
+        msg_type = msg.get_type()
+        system_id = msg.get_srcSystem()
+        vehicle = self.vehicles.get(system_id)
+        if vehicle is None:
+            if msg_type=='HEARTBEAT' and msg.type==mavutil.mavlink.MAV_TYPE_GCS:
+                # other ground stations on the network are not vehicles
+                return
+            vehicle = VehicleState(system_id, msg.get_srcComponent())
+            with self._state_lock:
+                self.vehicles[system_id] = vehicle
+                if self.drone_id is None:
+                    self.drone_id = system_id
+            print(f'Found vehicle with system ID {system_id}')
+            # request data
+            with self._send_lock:
+                self.mav_connection.mav.request_data_stream_send(system_id,
                                                                  msg.get_srcComponent(),
                                                                  mavutil.mavlink.MAV_DATA_STREAM_ALL, 4, 1)
-            else:
-                if msg.get_srcSystem() != self.drone_id:
-                    #print(f'Ignoring message from system ID {msg.get_srcSystem()}')
-                    return
-            msg_type = msg.get_type()
+        with self._state_lock:
             if msg_type=='GLOBAL_POSITION_INT':
-                if self.takeoff_time is None:
+                if vehicle.takeoff_time is None:
                     if msg.relative_alt > 50.0:
-                        self.takeoff_time = time.time()
-                        self.takeoff_pos_msg = msg
+                        vehicle.takeoff_time = time.time()
+                        vehicle.takeoff_pos_msg = msg
+                vehicle.battery.update_position(msg)
             elif msg_type=='BATTERY_STATUS':
-                pass
+                vehicle.battery.update_battery(msg, time.time())
             elif msg_type=='HEARTBEAT':
                 pass
-            self.last_msg_dict[msg_type] = msg
+            vehicle.last_msg_dict[msg_type] = msg
+
+    def snapshot(self,system_id=None):
+        "Consistent copy of the latest message of each type"
+        vehicle = self.vehicle(system_id)
+        if vehicle is None:
+            return {}
+        with self._state_lock:
+            return dict(vehicle.last_msg_dict)
 
-    def has_message(self,message_type):
-        return message_type in self.last_msg_dict.keys()
+    def last_message(self,message_type,system_id=None):
+        "Latest message of given type, or None if none yet"
+        vehicle = self.vehicle(system_id)
+        if vehicle:
+            return vehicle.last_msg_dict.get(message_type)
+
+    def has_message(self,message_type,system_id=None):
+        return self.last_message(message_type,system_id) is not None
     
-    def has_position(self):
-        return self.has_message('GLOBAL_POSITION_INT')
+    def has_position(self,system_id=None):
+        return self.has_message('GLOBAL_POSITION_INT',system_id)
 
-    def current_lat_lon(self):
+    def current_lat_lon(self,system_id=None):
         "(latitude, longitude) in decimal degrees, or None if unknown"
-        if self.has_message('GLOBAL_POSITION_INT'):
-            return (self.last_msg_dict['GLOBAL_POSITION_INT'].lat/1e7,
-                    self.last_msg_dict['GLOBAL_POSITION_INT'].lon/1e7)
+        msg = self.last_message('GLOBAL_POSITION_INT',system_id)
+        if msg:
+            return (msg.lat/1e7, msg.lon/1e7)
 
-    def current_hdg_deg(self):
-        if self.has_message('GLOBAL_POSITION_INT'):
-            return self.last_msg_dict['GLOBAL_POSITION_INT'].hdg/1e2
+    def current_hdg_deg(self,system_id=None):
+        msg = self.last_message('GLOBAL_POSITION_INT',system_id)
+        if msg:
+            return msg.hdg/1e2
 
-    def current_alt_asl(self):
+    def current_alt_asl(self,system_id=None):
         "in m, or None if unknown"
-        if self.has_message('GLOBAL_POSITION_INT'):
-            return self.last_msg_dict['GLOBAL_POSITION_INT'].alt/1e3
+        msg = self.last_message('GLOBAL_POSITION_INT',system_id)
+        if msg:
+            return msg.alt/1e3
 
-    def takeoff_lat_lon(self):
+    def takeoff_time(self,system_id=None):
+        "Time of takeoff in seconds since the epoch, or None if not yet"
+        vehicle = self.vehicle(system_id)
+        if vehicle:
+            return vehicle.takeoff_time
+
+    def takeoff_lat_lon(self,system_id=None):
         "(latitude, longitude) in decimal degrees, or None if unknown"
-        if self.takeoff_pos_msg:
-            return (self.takeoff_pos_msg.lat/1e7,
-                    self.takeoff_pos_msg.lon/1e7)
+        vehicle = self.vehicle(system_id)
+        if vehicle and vehicle.takeoff_pos_msg:
+            return (vehicle.takeoff_pos_msg.lat/1e7,
+                    vehicle.takeoff_pos_msg.lon/1e7)
 
-    def takeoff_alt_asl(self):
+    def takeoff_alt_asl(self,system_id=None):
         "in m, or None if unknown"
-        if self.takeoff_pos_msg:
-            return self.takeoff_pos_msg.alt/1e3
+        vehicle = self.vehicle(system_id)
+        if vehicle and vehicle.takeoff_pos_msg:
+            return vehicle.takeoff_pos_msg.alt/1e3
 
-    def time_since_takeoff(self):
+    def time_since_takeoff(self,system_id=None):
         "In seconds"
-        return time.time()-self.takeoff_time
+        return time.time()-self.takeoff_time(system_id)
 
-    def last_status(self):
-        if self.has_message('HEARTBEAT'):
-            return self.last_msg_dict['HEARTBEAT'].system_status
+    def last_status(self,system_id=None):
+        msg = self.last_message('HEARTBEAT',system_id)
+        if msg:
+            return msg.system_status
 
-    def in_air(self):
+    def in_air(self,system_id=None):
         "True if off ground"
-        return self.last_status()>3
+        status = self.last_status(system_id)
+        return status is not None and status>3
 
-    def endurance(self):
-        "In seconds"
+    def endurance(self,system_id=None,reserve_percent=30):
+        "Flight time in seconds from takeoff to the battery reserve"
+        vehicle = self.vehicle(system_id)
+        if vehicle and vehicle.takeoff_time:
+            with self._state_lock:
+                time_remaining = vehicle.battery.time_remaining(reserve_percent)
+            if time_remaining is not None:
+                return time.time() - vehicle.takeoff_time + time_remaining
         return 1800
 
-    def speed(self):
-        "In m/s"
+    def speed(self,system_id=None):
+        "Measured cruise speed in m/s"
+        vehicle = self.vehicle(system_id)
+        if vehicle:
+            with self._state_lock:
+                cruise_speed = vehicle.battery.cruise_speed()
+            if cruise_speed:
+                return cruise_speed
         return 10
 
-    def battery_time_remaining(self, target_percent):
+    def battery_time_remaining(self, target_percent, system_id=None):
         "Time to capacity target in seconds"
-        if 'BATTERY_STATUS' in self.last_msg_dict:
-            used_charge  = self.last_msg_dict['BATTERY_STATUS'].current_consumed
-            percent_remain = self.last_msg_dict['BATTERY_STATUS'].battery_remaining
-            if percent_remain==100:
-                return None
-            percent_used = 100 - percent_remain
-            capacity_estimate = used_charge * 100.0/percent_used #in mAh
-            #print(f'Estimate battery cap {capacity_estimate}')
-            last_current = self.last_msg_dict['BATTERY_STATUS'].current_battery*10.0 #to mA
-            if last_current==0.0:
-                return None
-            charge_over_target = capacity_estimate - used_charge - 0.01*target_percent*capacity_estimate
-            #print(f'Estimate {charge_over_target}mAh above target')
-            time_to_target = charge_over_target/last_current
-            return time_to_target*3600.0 #to seconds
-        else:
-            return None
+        vehicle = self.vehicle(system_id)
+        if vehicle:
+            with self._state_lock:
+                return vehicle.battery.time_remaining(target_percent)
@@ -0,0 +1,228 @@
+import time
+import argparse
+from math import sqrt, cos, atan2, pi
+from pymavlink import mavutil
+
+earth_radius = 6378137.0
+deg_to_rad = pi/180.0
+
+class SimVehicle:
+    """
+    Point-mass multirotor that flies straight to its position target
+    and reports itself like an ArduCopter in Guided mode
+    """
+
+    def __init__(self, system_id, link, lat, lon, alt_asl,
+                 speed=10.0, climb_rate=3.0, capacity=5000.0):
+        self.system_id = system_id
+        # all vehicles share one link, each encoding with its own IDs
+        self.mav = mavutil.mavlink.MAVLink(link, srcSystem=system_id, srcComponent=1)
+        self.lat = lat
+        self.lon = lon
+        self.alt_asl = alt_asl
+        self.home_asl = alt_asl
+        self.hdg_deg = 0.0
+        self.vel = (0.0, 0.0, 0.0)
+        self.speed = speed
+        self.climb_rate = climb_rate
+        self.capacity = capacity
+        self.consumed = 0.0
+        self.current = 0.0
+        self.target = None
+        self.boot_time = time.time()
+
+    def set_target(self, msg):
+        self.target = (msg.lat_int/1e7, msg.lon_int/1e7, msg.alt)
+
+    def in_air(self):
+        return self.alt_asl - self.home_asl > 1.0
+
+    def step(self, dt):
+        if self.target:
+            # flat earth offsets in m to the target
+            north = (self.target[0]-self.lat)*deg_to_rad*earth_radius
+            east = (self.target[1]-self.lon)*deg_to_rad*earth_radius*cos(self.lat*deg_to_rad)
+            up = self.target[2]-self.alt_asl
+            horiz = sqrt(north*north + east*east)
+            step_h = min(horiz, self.speed*dt)
+            step_v = max(-self.climb_rate*dt, min(up, self.climb_rate*dt))
+            if horiz > 0.1:
+                self.hdg_deg = (atan2(east, north)/deg_to_rad) % 360.0
+                north, east = north*step_h/horiz, east*step_h/horiz
+            self.lat += north/earth_radius/deg_to_rad
+            self.lon += east/(earth_radius*cos(self.lat*deg_to_rad))/deg_to_rad
+            self.alt_asl += step_v
+            self.vel = (north/dt, east/dt, -step_v/dt)
+        else:
+            self.vel = (0.0, 0.0, 0.0)
+        # hover current plus a share for forward flight, in A
+        self.current = 20.0 + 0.5*sqrt(self.vel[0]**2 + self.vel[1]**2) if self.in_air() else 0.5
+        self.consumed += self.current*1000.0*dt/3600.0
+
+    def time_boot_ms(self):
+        return int((time.time()-self.boot_time)*1000) & 0xFFFFFFFF
+
+    def send_heartbeat(self):
+        status = mavutil.mavlink.MAV_STATE_ACTIVE if self.in_air() else mavutil.mavlink.MAV_STATE_STANDBY
+        self.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_QUADROTOR,
+                                mavutil.mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA,
+                                mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+                                4,  # Guided
+                                status)
+
+    def send_position(self):
+        self.mav.global_position_int_send(self.time_boot_ms(),
+                                          int(self.lat*1e7),
+                                          int(self.lon*1e7),
+                                          int(self.alt_asl*1000),
+                                          int((self.alt_asl-self.home_asl)*1000),
+                                          int(self.vel[0]*100),
+                                          int(self.vel[1]*100),
+                                          int(self.vel[2]*100),
+                                          int(self.hdg_deg*100))
+
+    def send_battery(self):
+        remaining = max(0, int(100.0*(1.0 - self.consumed/self.capacity)))
+        self.mav.battery_status_send(0,  # id
+                                     mavutil.mavlink.MAV_BATTERY_FUNCTION_ALL,
+                                     mavutil.mavlink.MAV_BATTERY_TYPE_LIPO,
+                                     2500,  # temperature cdegC
+                                     [4000]*4 + [65535]*6,  # cell mV
+                                     int(self.current*100),  # cA
+                                     int(self.consumed),  # mAh
+                                     -1,  # energy
+                                     remaining)
+
+class Scheduler:
+    "Fires at a fixed rate without drifting"
+
+    def __init__(self, rate):
+        self.period = 1.0/rate if rate > 0 else None
+        self.next_time = time.time()
+
+    def due(self, now):
+        if self.period is None or now < self.next_time:
+            return False
+        self.next_time = max(self.next_time + self.period, now - self.period)
+        return True
+
+class MavSim:
+    """
+    Several SimVehicles on one MAVLink link, e.g. 'tcpin:127.0.0.1:5762'
+    like a SITL serial port, or 'udpout:127.0.0.1:14550'
+    """
+
+    def __init__(self, connect_str, num_vehicles=1, lat=52.8, lon=-4.12, alt_asl=10.0,
+                 position_rate=10.0, heartbeat_rate=1.0, battery_rate=1.0):
+        self.link = mavutil.mavlink_connection(connect_str, source_system=1)
+        self.vehicles = {}
+        for ii in range(num_vehicles):
+            # spread out along a line to the east
+            vehicle_lon = lon + ii*50.0/(earth_radius*cos(lat*deg_to_rad))/deg_to_rad
+            self.vehicles[ii+1] = SimVehicle(ii+1, self.link, lat, vehicle_lon, alt_asl)
+        self.schedules = {'position': Scheduler(position_rate),
+                          'heartbeat': Scheduler(heartbeat_rate),
+                          'battery': Scheduler(battery_rate)}
+        self.num_sent = 0
+        self.num_targets = 0
+
+    def receive(self):
+        while True:
+            msg = self.link.recv_match(blocking=False)
+            if msg is None:
+                return
+            if msg.get_type()=='SET_POSITION_TARGET_GLOBAL_INT':
+                vehicle = self.vehicles.get(msg.target_system)
+                if vehicle:
+                    vehicle.set_target(msg)
+                    self.num_targets += 1
+
+    def step(self, dt):
+        self.receive()
+        now = time.time()
+        for name, schedule in self.schedules.items():
+            if schedule.due(now):
+                for vehicle in self.vehicles.values():
+                    getattr(vehicle, f'send_{name}')()
+                    self.num_sent += 1
+        for vehicle in self.vehicles.values():
+            vehicle.step(dt)
+
+    def run(self, duration=None, dt=0.01):
+        start_time = time.time()
+        last_time = start_time
+        while duration is None or time.time() < start_time + duration:
+            time.sleep(dt)
+            now = time.time()
+            self.step(now - last_time)
+            last_time = now
+
+def benchmark(args):
+    """
+    Run the simulator and a DroneInterface in one process and report
+    message throughput and latency from sending to the latest state
+    """
+    import threading
+    from drone_interface import DroneInterface
+    sim = MavSim(args.connect, args.vehicles, position_rate=args.position_rate,
+                 heartbeat_rate=args.heartbeat_rate, battery_rate=args.battery_rate)
+    sim_thread = threading.Thread(target=sim.run, args=(args.bench+1.0,), daemon=True)
+    sim_thread.start()
+    drone = DroneInterface(args.listen)
+    drone.start()
+    latencies = []
+    last_seen = {}
+    start_time = time.time()
+    start_count = None
+    while time.time() < start_time + args.bench:
+        time.sleep(0.001)
+        if start_count is None and drone.vehicle_ids():
+            start_count = (time.time(), drone.message_count)
+        for system_id in drone.vehicle_ids():
+            msg = drone.last_message('GLOBAL_POSITION_INT', system_id)
+            if msg and last_seen.get(system_id) != msg.time_boot_ms:
+                last_seen[system_id] = msg.time_boot_ms
+                sent_time = sim.vehicles[system_id].boot_time + msg.time_boot_ms/1000.0
+                latencies.append(time.time() - sent_time)
+    drone.stop()
+    if not latencies:
+        print('No telemetry received')
+        return
+    elapsed = time.time() - start_count[0]
+    latencies.sort()
+    print(f'{len(drone.vehicle_ids())} vehicles, '
+          f'{(drone.message_count-start_count[1])/elapsed:.0f} msgs/s received, '
+          f'{sim.num_sent/args.bench:.0f} msgs/s sent')
+    print(f'Position latency ms: median {1000*latencies[len(latencies)//2]:.1f}, '
+          f'p99 {1000*latencies[int(0.99*(len(latencies)-1))]:.1f}, '
+          f'max {1000*latencies[-1]:.1f}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--connect',
+                        help='Link for the simulator e.g. tcpin:127.0.0.1:5762 or udpout:127.0.0.1:14550',
+                        default='tcpin:127.0.0.1:5762')
+    parser.add_argument('-n', '--vehicles', type=int, default=1,
+                        help='Number of simulated vehicles')
+    parser.add_argument('--position_rate', type=float, default=10.0,
+                        help='GLOBAL_POSITION_INT rate per vehicle in Hz')
+    parser.add_argument('--heartbeat_rate', type=float, default=1.0,
+                        help='HEARTBEAT rate per vehicle in Hz')
+    parser.add_argument('--battery_rate', type=float, default=1.0,
+                        help='BATTERY_STATUS rate per vehicle in Hz')
+    parser.add_argument('--bench', type=float, default=None,
+                        help='Run a benchmark for this many seconds instead')
+    parser.add_argument('--listen',
+                        help='Connection string for the benchmark receiver',
+                        default='tcp:127.0.0.1:5762')
+    args = parser.parse_args()
+    if args.bench:
+        benchmark(args)
+    else:
+        sim = MavSim(args.connect, args.vehicles, position_rate=args.position_rate,
+                     heartbeat_rate=args.heartbeat_rate, battery_rate=args.battery_rate)
+        print(f'Simulating {args.vehicles} vehicles on {args.connect}')
+        sim.run()
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,85 @@
+import sqlite3
+import threading
+import time
+
+class MessageStore:
+    """
+    Chat messages in an SQLite database in WAL mode, so any number of
+    server threads or processes can add and read them at once.
+
+    Every message gets an ID one more than the last, so a reader that
+    remembers the last ID it saw can fetch just the newer ones, and any
+    number of readers each see every message.
+
+    Readers can also wait for new messages.  Adds in this process wake
+    them at once, and the database is checked every poll_period in case
+    another process added some.
+    """
+
+    def __init__(self, db_path='chat_messages.db', poll_period=1.0):
+        self.db_path = db_path
+        self.poll_period = poll_period
+        self._local = threading.local()
+        # bumped on every add, so waiters can tell if they missed one
+        self._new_message = threading.Condition()
+        self._version = 0
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                name TEXT NOT NULL,
+                                time TEXT NOT NULL,
+                                msg TEXT,
+                                lat REAL,
+                                lon REAL)''')
+
+    def connection(self):
+        "Connection for the calling thread, as sqlite3 connections cannot be shared"
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10.0)
+            conn.row_factory = sqlite3.Row
+            # safe in WAL mode and much faster than a sync per message
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add(self, name, time, msg, lat=None, lon=None):
+        "Store a message and return its ID"
+        with self.connection() as conn:
+            cursor = conn.execute('INSERT INTO messages (name, time, msg, lat, lon) VALUES (?, ?, ?, ?, ?)',
+                                  (name, time, msg, lat, lon))
+        with self._new_message:
+            self._version += 1
+            self._new_message.notify_all()
+        return cursor.lastrowid
+
+    def wait_for(self, last_id=0, timeout=25.0, limit=100):
+        "Messages after last_id as soon as there are any, or [] after timeout"
+        deadline = time.time() + timeout
+        while True:
+            with self._new_message:
+                version = self._version
+            messages = self.since(last_id, limit)
+            remaining = deadline - time.time()
+            if messages or remaining <= 0:
+                return messages
+            with self._new_message:
+                if self._version==version:
+                    self._new_message.wait(min(remaining, self.poll_period))
+
+    def since(self, last_id=0, limit=100):
+        "Up to limit messages with IDs after last_id, oldest first"
+        rows = self.connection().execute('SELECT * FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                                         (last_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def recent(self, limit=100):
+        "The last limit messages, oldest first"
+        rows = self.connection().execute('SELECT * FROM messages ORDER BY id DESC LIMIT ?',
+                                         (limit,)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def last_id(self):
+        row = self.connection().execute('SELECT MAX(id) FROM messages').fetchone()
+        return row[0] or 0
@@ -0,0 +1,197 @@
+import os
+import time
+import struct
+import argparse
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from pymavlink import mavutil
+
+# index entries are (timestamp in usec, byte offset) as big-endian uint64
+INDEX_DTYPE = np.dtype('>u8')
+
+def index_file_name(filename):
+    return filename + '.idx'
+
+def build_index(filename, index_interval=1.0):
+    """
+    Scan a tlog once and write its time index, for logs recorded by
+    other tools.  Returns the index as an N x 2 array.
+    """
+    entries = []
+    last_usec = None
+    log = mavutil.mavlink_connection(filename)
+    while True:
+        offset = log.f.tell()
+        msg = log.recv_msg()
+        if msg is None:
+            break
+        usec = int(msg._timestamp*1.0e6)
+        if last_usec is None or usec >= last_usec + index_interval*1.0e6:
+            entries.append((usec, offset))
+            last_usec = usec
+    log.close()
+    index = np.array(entries, dtype=INDEX_DTYPE).reshape(-1, 2)
+    index.tofile(index_file_name(filename))
+    return index
+
+def read_index(filename):
+    "N x 2 array of (usec, offset), building it if missing"
+    try:
+        return np.fromfile(index_file_name(filename), dtype=INDEX_DTYPE).reshape(-1, 2)
+    except OSError:
+        return build_index(filename)
+
+class TelemetryRecorder:
+    """
+    Append MAVLink messages to a tlog, the format Mission Planner and
+    pymavlink read, with a time index beside it for fast seeking.  Both
+    are flushed at each index entry, so a crash loses at most
+    index_interval of telemetry.
+    """
+
+    def __init__(self, filename, index_interval=1.0):
+        self.filename = filename
+        self.index_interval = index_interval
+        self.log_file = open(filename, 'ab')
+        self.index_file = open(index_file_name(filename), 'ab')
+        self.last_index_usec = None
+        self.num_messages = 0
+
+    def record(self, msg):
+        if msg.get_type()=='BAD_DATA':
+            return
+        usec = int(getattr(msg, '_timestamp', time.time())*1.0e6) & ~3
+        offset = self.log_file.tell()
+        self.log_file.write(struct.pack('>Q', usec) + msg.get_msgbuf())
+        self.num_messages += 1
+        if self.last_index_usec is None or usec >= self.last_index_usec + self.index_interval*1.0e6:
+            # log first, so after a crash the index never points past its end
+            self.log_file.flush()
+            self.index_file.write(struct.pack('>QQ', usec, offset))
+            self.index_file.flush()
+            self.last_index_usec = usec
+
+    def close(self):
+        self.log_file.close()
+        self.index_file.close()
+
+class NullWriter:
+    "Swallows commands sent during replay"
+
+    def write(self, buf):
+        return len(buf)
+
+class TelemetryReplay:
+    """
+    Plays a tlog back with the recv_match interface of a pymavlink
+    connection, so it can stand in for a live link.  speed is a multiple
+    of real time, or None for as fast as possible.
+    """
+
+    def __init__(self, filename, speed=1.0, start=0.0):
+        self.filename = filename
+        self.speed = speed
+        self.index = read_index(filename)
+        # commands to the vehicle go nowhere
+        self.mav = mavutil.mavlink.MAVLink(NullWriter(), srcSystem=255)
+        self.log = None
+        self.first_time = self.index[0,0]*1.0e-6 if len(self.index) else 0.0
+        self.seek(start)
+
+    @classmethod
+    def from_connect_string(cls, connect_str):
+        """
+        Replay from 'replay:<file>?speed=<x>&start=<secs>', where speed 0
+        means as fast as possible and start is from the start of the log
+        """
+        parts = urlsplit(connect_str[len('replay:'):])
+        options = parse_qs(parts.query)
+        speed = float(options.get('speed', ['1'])[0]) or None
+        start = float(options.get('start', ['0'])[0])
+        return cls(parts.path, speed=speed, start=start)
+
+    def seek(self, secs):
+        "Jump to secs after the start of the log, using the index"
+        target_usec = (self.first_time + secs)*1.0e6
+        pos = max(np.searchsorted(self.index[:,0], target_usec, side='right') - 1, 0)
+        if self.log:
+            self.log.close()
+        # fresh reader so no partial message is left in the parser
+        self.log = mavutil.mavlink_connection(self.filename)
+        if len(self.index):
+            self.log.f.seek(int(self.index[pos,1]))
+        self.pending = None
+        # skip the few messages between the index entry and the target
+        while True:
+            msg = self.log.recv_msg()
+            if msg is None or msg._timestamp*1.0e6 >= target_usec:
+                self.pending = msg
+                break
+        self.log_anchor = self.pending._timestamp if self.pending else None
+        self.wall_anchor = time.time()
+
+    def log_time(self):
+        "Seconds into the log of the next message"
+        if self.pending:
+            return self.pending._timestamp - self.first_time
+
+    def _due_in(self, msg):
+        if self.speed is None:
+            return 0.0
+        due = self.wall_anchor + (msg._timestamp - self.log_anchor)/self.speed
+        return due - time.time()
+
+    def recv_match(self, type=None, blocking=False, timeout=None):
+        if type is not None and not isinstance(type, (list, set)):
+            type = [type]
+        start_time = time.time()
+        while True:
+            if self.pending is None:
+                self.pending = self.log.recv_msg()
+            msg = self.pending
+            if msg is None:
+                # end of log
+                if blocking:
+                    time.sleep(timeout if timeout is not None else 0.05)
+                return None
+            wait = self._due_in(msg)
+            if wait > 0:
+                if not blocking:
+                    return None
+                if timeout is not None:
+                    wait = min(wait, start_time + timeout - time.time())
+                if wait <= 0:
+                    return None
+                time.sleep(wait)
+                continue
+            self.pending = None
+            if msg.get_type()=='BAD_DATA':
+                continue
+            if type is not None and msg.get_type() not in type:
+                continue
+            # replayed messages look as if they arrived now
+            msg._timestamp = time.time()
+            return msg
+
+    def close(self):
+        self.log.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log_file', help='tlog to summarise')
+    parser.add_argument('--reindex', action='store_true', help='Rebuild the time index')
+    args = parser.parse_args()
+    if args.reindex and os.path.exists(index_file_name(args.log_file)):
+        os.remove(index_file_name(args.log_file))
+    index = read_index(args.log_file)
+    replay = TelemetryReplay(args.log_file, speed=None)
+    num_msgs = 0
+    start_time = time.time()
+    while replay.recv_match() is not None:
+        num_msgs += 1
+    replay.close()
+    print(f'{num_msgs} messages over {(index[-1,0]-index[0,0])*1.0e-6:.0f}s of log, '
+          f'{len(index)} index entries, replayed in {time.time()-start_time:.2f}s')
+
+if __name__=='__main__':
+    main()
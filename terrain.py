@@ -1,116 +1,694 @@
+import json
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import RegularGridInterpolator
+
+HEADER_KEYS = {'nrows': int,
+               'ncols': int,
+               'xllcorner': float,
+               'yllcorner': float,
+               'cellsize': float,
+               'nodata_value': float}
+
+DERIVED_LAYERS = ('slope', 'aspect', 'roughness')
+
+def cache_file_names(filename):
+    "(heights, header) paths of the binary cache kept beside an .asc tile"
+    return filename + '.cache.npy', filename + '.cache.json'
+
+def layer_file_name(filename, layer):
+    "Path of the cached derived layer kept beside an .asc tile"
+    return filename + f'.{layer}.npy'
+
+def read_asc_header(f):
+    "Read the ESRI ASCII grid header, leaving f at the first height row"
+    header = {}
+    while True:
+        pos = f.tell()
+        line_bits = f.readline().split()
+        key = line_bits[0].lower() if line_bits else None
+        if key not in HEADER_KEYS:
+            # must be first height row line
+            f.seek(pos)
+            return header
+        header[key] = HEADER_KEYS[key](line_bits[1])
+
+def read_asc(filename):
+    """
+    header, z = read_asc(filename)
+
+    header is a dict of the ESRI ASCII grid header values
+    z is a float32 array with row 0 at the southern edge
+    """
+    with open(filename, 'r', encoding='ascii') as f:
+        header = read_asc_header(f)
+        z = np.loadtxt(f, dtype=np.float32, ndmin=2)
+    assert z.shape==(header['nrows'], header['ncols'])
+    if 'nodata_value' in header:
+        z[z==header['nodata_value']] = np.nan
+    # file runs north to south
+    return header, np.ascontiguousarray(z[::-1])
+
+def write_tile_cache(filename):
+    "Parse an .asc tile and save it as binary beside the original"
+    header, z = read_asc(filename)
+    npy_file, json_file = cache_file_names(filename)
+    header['source_mtime'] = os.path.getmtime(filename)
+    np.save(npy_file, z)
+    # header written last so a half-written cache is never trusted
+    with open(json_file, 'w', encoding='ascii') as f:
+        json.dump(header, f)
+    return header
+
+def read_tile_cache(filename):
+    "Header dict from the binary cache, or None if missing, stale or incomplete"
+    npy_file, json_file = cache_file_names(filename)
+    try:
+        with open(json_file, 'r', encoding='ascii') as f:
+            header = json.load(f)
+        if header.get('source_mtime')!=os.path.getmtime(filename):
+            return None
+        # mapping fails if the heights were cut short
+        z = np.load(npy_file, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if z.shape!=(header['nrows'], header['ncols']):
+        return None
+    return header
+
+def grid_interp(z, x0, y0, cellsize, x, y, nearest=False):
+    """
+    Bilinear interpolation by index arithmetic in grid z, whose point
+    (row i, column j) is at (x0 + j*cellsize, y0 + i*cellsize).
+    Points beyond the last grid line take the edge value.
+    With nearest set, take the nearest grid point instead.
+    """
+    nrows, ncols = z.shape
+    fx = np.nan_to_num(np.clip((np.asarray(x, dtype=float) - x0)/cellsize, 0, ncols-1))
+    fy = np.nan_to_num(np.clip((np.asarray(y, dtype=float) - y0)/cellsize, 0, nrows-1))
+    if nearest:
+        return z[np.rint(fy).astype(int), np.rint(fx).astype(int)]
+    ix = np.minimum(fx.astype(int), max(ncols-2, 0))
+    iy = np.minimum(fy.astype(int), max(nrows-2, 0))
+    tx = fx - ix
+    ty = fy - iy
+    ix1 = np.minimum(ix+1, ncols-1)
+    iy1 = np.minimum(iy+1, nrows-1)
+    return ((z[iy,ix]*(1-tx) + z[iy,ix1]*tx)*(1-ty) +
+            (z[iy1,ix]*(1-tx) + z[iy1,ix1]*tx)*ty)
+
+def terrain_derivatives(padded_z, cellsize):
+    """
+    Slope and aspect in degrees and roughness in m from a height grid
+    padded by one cell all round, as a dict of float32 arrays the size of
+    the unpadded grid.  Aspect is the compass bearing the slope faces and
+    roughness is the mean absolute difference to the eight neighbours.
+    """
+    z = np.array(padded_z, dtype=float)
+    # extrapolate missing padding so the edge differences become one-sided
+    for edge, inner, outer in ((0, 1, 2), (-1, -2, -3)):
+        z[edge] = np.where(np.isnan(z[edge]), 2*z[inner] - z[outer], z[edge])
+        z[:,edge] = np.where(np.isnan(z[:,edge]), 2*z[:,inner] - z[:,outer], z[:,edge])
+    centre = z[1:-1,1:-1]
+    # rows run northwards
+    dzdx = (z[1:-1,2:] - z[1:-1,:-2])/(2*cellsize)
+    dzdy = (z[2:,1:-1] - z[:-2,1:-1])/(2*cellsize)
+    roughness = np.zeros_like(centre)
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di or dj:
+                roughness += np.abs(z[1+di:z.shape[0]-1+di,1+dj:z.shape[1]-1+dj] - centre)
+    return {'slope': np.degrees(np.arctan(np.hypot(dzdx, dzdy))).astype(np.float32),
+            'aspect': (np.degrees(np.arctan2(-dzdx, -dzdy)) % 360.0).astype(np.float32),
+            'roughness': (roughness/8.0).astype(np.float32)}
 
 class TerrainTile:
 
-    def __init__(self, filename):
-        self.nrows = None
-        self.ncols = None
-        self.xllcorner = None
-        self.yllcorner = None
-        self.cellsize = None
+    def __init__(self, filename, use_cache=True, lazy=False):
+        self.filename = filename
+        self.use_cache = use_cache
         self.Z = None
-        num_rows_read = 0
-        with open(filename, 'r', encoding='ascii') as f:
-            for line in f:
-                line_bits = [item.strip() for item in line.split(' ')]
-                if line_bits[0]=='nrows':
-                    self.nrows = int(line_bits[1])
-                    print(f'Tile has {self.nrows} rows')                    
-                elif line_bits[0]=='ncols':
-                    self.ncols = int(line_bits[1])
-                    print(f'Tile has {self.ncols} columns')                    
-                elif line_bits[0]=='xllcorner':
-                    self.xllcorner = float(line_bits[1])
-                    print(f'X lower left is {self.xllcorner}')                    
-                elif line_bits[0]=='yllcorner':
-                    self.yllcorner = float(line_bits[1])
-                    print(f'Y lower left is {self.yllcorner}')
-                elif line_bits[0]=='cellsize':
-                    self.cellsize = float(line_bits[1])
-                    print(f'Cell size is {self.cellsize}')
-                else:
-                    # must be height row line
-                    if self.Z is None:
-                        # check we've had all the data we need
-                        assert self.ncols is not None
-                        # initiailize the array
-                        self.Z = np.zeros((self.nrows,self.ncols))
-                    assert len(line_bits)==self.ncols
-                    self.Z[self.nrows - 1 - num_rows_read] = np.array(line_bits, dtype=float)
-                    num_rows_read += 1
-        print(f'Read {num_rows_read} rows')
-        assert self.nrows==num_rows_read
-        self.x = np.arange(self.xllcorner,
-                           self.xllcorner+self.ncols*self.cellsize,
-                           self.cellsize)
-        self.y = np.arange(self.yllcorner,
-                           self.yllcorner+self.nrows*self.cellsize,
-                           self.cellsize)
-        self._interp = RegularGridInterpolator((self.x,self.y),self.Z.T,bounds_error=False)
+        self.layers = {}
+        # only the header is needed until the heights are used
+        header = read_tile_cache(filename) if use_cache else None
+        if header is None:
+            with open(filename, 'r', encoding='ascii') as f:
+                header = read_asc_header(f)
+        self.nrows = header['nrows']
+        self.ncols = header['ncols']
+        self.xllcorner = header['xllcorner']
+        self.yllcorner = header['yllcorner']
+        self.cellsize = header['cellsize']
+        print(f'Tile has {self.nrows} rows and {self.ncols} columns')
+        print(f'Lower left is {self.xllcorner},{self.yllcorner} with cell size {self.cellsize}')
+        self.x = self.xllcorner + self.cellsize*np.arange(self.ncols)
+        self.y = self.yllcorner + self.cellsize*np.arange(self.nrows)
+        if not lazy:
+            self.load()
+
+    def is_loaded(self):
+        return self.Z is not None
+
+    def nbytes(self):
+        "Memory used by the heights and any derived layers once loaded"
+        return (1 + len(self.layers))*self.nrows*self.ncols*np.dtype(np.float32).itemsize
+
+    def load(self):
+        "Read the heights, from the binary cache if possible"
+        if self.Z is not None:
+            return
+        if self.use_cache:
+            if read_tile_cache(self.filename) is None:
+                print(f'Building cache for {self.filename}')
+                try:
+                    write_tile_cache(self.filename)
+                except OSError:
+                    print(f'Unable to write cache for {self.filename}')
+                    _, self.Z = read_asc(self.filename)
+                    return
+            # memory map the cached heights
+            self.Z = np.load(cache_file_names(self.filename)[0], mmap_mode='r')
+        else:
+            _, self.Z = read_asc(self.filename)
+
+    def unload(self):
+        self.Z = None
+        self.layers = {}
+
+    def has_layer_cache(self, layer):
+        "True if the cached layer exists and is newer than the tile"
+        try:
+            return (os.path.getmtime(layer_file_name(self.filename, layer)) >=
+                    os.path.getmtime(self.filename))
+        except OSError:
+            return False
+
+    def load_layer(self, layer):
+        "Memory map a cached derived layer, returning False if not cached"
+        if layer in self.layers:
+            return True
+        if not (self.use_cache and self.has_layer_cache(layer)):
+            return False
+        try:
+            self.layers[layer] = np.load(layer_file_name(self.filename, layer), mmap_mode='r')
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def save_layers(self, layers):
+        "Write freshly computed layers to the cache if allowed, returning True if all were"
+        if not self.use_cache:
+            return False
+        saved = True
+        for layer, values in layers.items():
+            try:
+                np.save(layer_file_name(self.filename, layer), values)
+            except OSError:
+                print(f'Unable to cache {layer} for {self.filename}')
+                saved = False
+        return saved
+
+    def set_layers(self, layers):
+        "Keep freshly computed layers in memory"
+        self.layers.update(layers)
+
+    def drop_layers(self, keep=None):
+        "Forget loaded layers other than keep, returning True if any were"
+        dropped = [layer for layer in self.layers if layer!=keep]
+        for layer in dropped:
+            del self.layers[layer]
+        return bool(dropped)
 
     def plot(self, ax=None, show=True):
         if ax is None:
             _, ax = plt.subplots(subplot_kw={"projection": "3d"})
+        self.load()
         xg,yg = np.meshgrid(self.x,self.y)
         # Plot the surface
         ax.plot_surface(xg, yg, self.Z)
         if show:
             plt.show()
 
-    def lookup(self,x,y):
-        return self._interp((x,y))
+    def lookup(self,x,y,layer='height'):
+        """
+        Height at (x,y), which may be scalars or arrays
+
+        Points between the last grid line and the edge of the tile's
+        footprint take the edge value, so adjoining tiles leave no gaps
+        (a TerrainTileCollection interpolates them across the seam).
+        Points outside the footprint give NaN.
+
+        Other layers must already be loaded, and aspect is taken from the
+        nearest grid point as it wraps round at north.
+        """
+        if layer=='height':
+            self.load()
+            values = self.Z
+        else:
+            values = self.layers[layer]
+        inside = self.covers(x,y)
+        z = grid_interp(values, self.xllcorner, self.yllcorner, self.cellsize, x, y,
+                        nearest=(layer=='aspect'))
+        return np.where(inside, z, np.nan)
+
+    def covers(self,x,y):
+        "True where (x,y) lies in the footprint of this tile"
+        xmin, xmax, ymin, ymax = self.extent()
+        return (x>=xmin) & (x<xmax) & (y>=ymin) & (y<ymax)
+
+    def extent(self):
+        "(xmin, xmax, ymin, ymax) of the tile footprint"
+        return (self.xllcorner, self.xllcorner+self.width(),
+                self.yllcorner, self.yllcorner+self.height())
+
+    def width(self):
+        return self.ncols*self.cellsize
+
+    def height(self):
+        return self.nrows*self.cellsize
 
 class TerrainTileCollection:
 
-    def __init__(self,search_root='.'):
+    def __init__(self,search_root='.',memory_limit=None):
+        """
+        Tiles are found by walking search_root but only their headers are
+        read here.  Heights are loaded when a lookup first lands in a tile
+        and the least recently used tiles are unloaded to keep the total
+        under memory_limit bytes (None for no limit).
+        """
         self.tiles = []
+        self.memory_limit = memory_limit
+        self._resident = OrderedDict()
+        self._overviews = OrderedDict()
+        self._lock = threading.RLock()
+        self.layers_ready = threading.Event()
         for root, _, files in os.walk(search_root):
             for filename in files:
                 if filename.lower().endswith('.asc'):
                     full_path = os.path.join(root, filename)
-                    print(f'Loading {full_path}')
-                    self.tiles.append(TerrainTile(full_path))
+                    print(f'Found {full_path}')
+                    self.tiles.append(TerrainTile(full_path, lazy=True))
+        self._build_index()
+
+    def build_caches(self,max_workers=None):
+        """
+        Convert every tile without a fresh binary cache, in parallel
+        across max_workers processes (default one per core).  Workers
+        write the heights to disk and only return the small header, so
+        the arrays are memory mapped rather than pickled back.  Tiles whose
+        cache cannot be written are left to be read when first used.
+        """
+        stale = [t.filename for t in self.tiles
+                 if t.use_cache and read_tile_cache(t.filename) is None]
+        if not stale:
+            return
+        print(f'Converting {len(stale)} tiles')
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(write_tile_cache, filename) for filename in stale]
+            for filename, future in zip(stale, futures):
+                try:
+                    result = future.result()
+                except OSError as e:
+                    print(f'Unable to write cache for {filename}: {e}')
+                    continue
+                print(f'Cached {filename} with {result["nrows"]} rows')
+
+    def get_tile(self,ii,layer='height'):
+        """
+        Tile ii with its heights loaded, and the given derived layer too
+        if build_layers has computed it.  Old tiles are evicted if over
+        budget.  Another thread may evict the tile once the lock is
+        released, so only use it while holding _lock, as tile_lookup does.
+        """
+        with self._lock:
+            tile = self.tiles[ii]
+            tile.load()
+            if layer!='height':
+                tile.load_layer(layer)
+            self._resident[ii] = tile
+            self._resident.move_to_end(ii)
+            self._evict(keep_layer=layer)
+            return tile
+
+    def _evict(self, keep_layer='height'):
+        """
+        Unload the least recently used tiles, then drop the least recently
+        used overviews, until under memory_limit.  The newest tile and
+        overview are kept, but the newest tile only keeps keep_layer of
+        its derived layers if still over.
+        """
+        if self.memory_limit is None:
+            return
+        with self._lock:
+            while self.resident_bytes()>self.memory_limit:
+                if len(self._resident)>1:
+                    _, old_tile = self._resident.popitem(last=False)
+                    old_tile.unload()
+                elif len(self._overviews)>1:
+                    self._overviews.popitem(last=False)
+                else:
+                    newest = next(reversed(self._resident.values()), None)
+                    if newest is None or not newest.drop_layers(keep=keep_layer):
+                        break
+
+    def tile_lookup(self,ii,x,y,layer='height'):
+        """
+        Lookup in tile ii, kept loaded for the duration.  Derived layers
+        not yet computed by build_layers give NaN rather than holding up
+        the caller.
+        """
+        with self._lock:
+            tile = self.get_tile(ii,layer)
+            if layer!='height' and layer not in tile.layers:
+                return np.full(np.broadcast(x, y).shape, np.nan)
+            z = tile.lookup(x,y,layer)
+            if layer=='height':
+                z = self._seam_interp(ii,x,y,z)
+            return z
+
+    def _peek_lookup(self,ii,x,y):
+        "Heights from tile ii, leaving which tiles are loaded and their LRU order alone"
+        with self._lock:
+            tile = self.tiles[ii]
+            if ii in self._resident:
+                return tile.lookup(x,y)
+            tile.load()
+            z = tile.lookup(x,y)
+            tile.unload()
+            return z
+
+    def _seam_interp(self,ii,x,y,z,keep_loaded=True):
+        """
+        Heights z from tile ii, with the points past its last grid line
+        interpolated towards the first grid line of the neighbouring tile
+        instead of taking the edge value.  At the edge of the map they
+        keep the edge value.  With keep_loaded False the neighbours are
+        read as in to_nparray, without pushing other tiles out.
+        """
+        tile = self.tiles[ii]
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                      np.array(z, dtype=float))
+        z = z.copy()
+        cellsize = tile.cellsize
+        fx = (x - tile.xllcorner)/cellsize
+        fy = (y - tile.yllcorner)/cellsize
+        seam = ~np.isnan(z) & ((fx>tile.ncols-1) | (fy>tile.nrows-1))
+        if not seam.any():
+            return z
+        # corners of the cell each point is in, some beyond the tile
+        ix = np.minimum(np.floor(fx[seam]), tile.ncols-1)
+        iy = np.minimum(np.floor(fy[seam]), tile.nrows-1)
+        corner_x = tile.xllcorner + cellsize*(ix + np.array([0, 1, 0, 1])[:,None])
+        corner_y = tile.yllcorner + cellsize*(iy + np.array([0, 0, 1, 1])[:,None])
+        # read this tile first, as loading neighbours may evict it
+        edge_z = grid_interp(tile.Z, tile.xllcorner, tile.yllcorner, cellsize,
+                             corner_x, corner_y)
+        corner_z = np.where(tile.covers(corner_x, corner_y), edge_z, np.nan)
+        missing = np.isnan(corner_z)
+        if missing.any():
+            if keep_loaded:
+                neighbour_lookup = lambda jj, x, y: self.get_tile(jj).lookup(x, y)
+            else:
+                neighbour_lookup = self._peek_lookup
+            corner_z[missing] = self._bucket_lookup(corner_x[missing], corner_y[missing],
+                                                    neighbour_lookup, skip=ii)
+        corner_z = np.where(np.isnan(corner_z), edge_z, corner_z)
+        tx = fx[seam] - ix
+        ty = fy[seam] - iy
+        z[seam] = ((corner_z[0]*(1-tx) + corner_z[1]*tx)*(1-ty) +
+                   (corner_z[2]*(1-tx) + corner_z[3]*tx)*ty)
+        return z
+
+    def _compute_layers(self,ii):
+        "Derived layers of tile ii, using its neighbours across the seams"
+        tile = self.tiles[ii]
+        xmin, xmax, ymin, ymax = tile.extent()
+        cellsize = tile.cellsize
+        _, _, padded = self.to_nparray(cellsize=cellsize,
+                                       bounds=(xmin-cellsize, xmax+cellsize,
+                                               ymin-cellsize, ymax+cellsize),
+                                       keep_loaded=False)
+        with self._lock:
+            padded[1:-1,1:-1] = self.get_tile(ii).Z
+        return terrain_derivatives(padded, cellsize)
+
+    def build_layers(self):
+        "Compute and cache derived layers for every tile that lacks them"
+        for ii, tile in enumerate(self.tiles):
+            if not all(tile.has_layer_cache(layer) for layer in DERIVED_LAYERS):
+                print(f'Computing derived layers for {tile.filename}')
+                layers = self._compute_layers(ii)
+                # written without the lock, so lookups are not held up, and
+                # memory mapped from the cache when next wanted
+                if not tile.save_layers(layers):
+                    with self._lock:
+                        self.get_tile(ii).set_layers(layers)
+                        self._evict()
+        self.layers_ready.set()
+
+    def build_layers_in_background(self):
+        "Run build_layers on a thread, setting layers_ready when done"
+        worker = threading.Thread(target=self.build_layers, daemon=True)
+        worker.start()
+        return worker
+
+    def resident_bytes(self):
+        "Memory used by loaded tiles and overviews"
+        return (sum(t.nbytes() for t in self._resident.values()) +
+                sum(z.nbytes for _, _, z in self._overviews.values()))
+
+    def _build_index(self):
+        """
+        Bucket the tiles on a regular grid the size of the smallest tile,
+        so a point only needs testing against the few tiles in its bucket
+        """
+        self._index = {}
+        if not self.tiles:
+            self.bucket_size = 1.0
+            return
+        self.bucket_size = min(min(t.width(), t.height()) for t in self.tiles)
+        # finest resolution first, so it wins where tiles overlap
+        for ii in sorted(range(len(self.tiles)), key=lambda k: self.tiles[k].cellsize):
+            xmin, xmax, ymin, ymax = self.tiles[ii].extent()
+            for bx in range(int(np.floor(xmin/self.bucket_size)),
+                            int(np.ceil(xmax/self.bucket_size))):
+                for by in range(int(np.floor(ymin/self.bucket_size)),
+                                int(np.ceil(ymax/self.bucket_size))):
+                    self._index.setdefault((bx,by), []).append(ii)
+
+    def tiles_at(self,x,y):
+        "Indices of the tiles that might cover point (x,y)"
+        if not (np.isfinite(x) and np.isfinite(y)):
+            return []
+        key = (int(np.floor(x/self.bucket_size)), int(np.floor(y/self.bucket_size)))
+        return self._index.get(key, [])
 
     def plot_tiles(self, ax=None, show=True):
         if ax is None:
             _, ax = plt.subplots(subplot_kw={"projection": "3d"})
-        for tile in self.tiles:
-            tile.plot(ax=ax,show=False)
+        for ii in range(len(self.tiles)):
+            with self._lock:
+                self.get_tile(ii).plot(ax=ax,show=False)
         if show:
             plt.show()
 
-    def lookup(self,x,y):
-        for ii,tile in enumerate(self.tiles):
-            z = tile.lookup(x,y)
+    def lookup(self,x,y,layer='height'):
+        z = np.nan
+        for ii in self.tiles_at(x,y):
+            z = self.tile_lookup(ii,x,y,layer)
             if not np.isnan(z):
                 #print(f'Tile {ii} has it with height {z}.')
                 break
         return z
     
-    def to_nparray(self):
+    def lookup_many(self,xs,ys,resolution=None,layer='height'):
+        """
+        zs = tile_collection.lookup_many(xs,ys)
+
+        xs and ys are arrays of eastings and northings of the same shape
+        zs has that shape too, with NaN for points off the map
+
+        With resolution given in m, the coarsest overview level no coarser
+        than that is used instead of the full resolution tiles.
+        layer selects 'height' or one of DERIVED_LAYERS, always at full
+        resolution.
+        """
+        xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=float),
+                                     np.asarray(ys, dtype=float))
+        if resolution is not None and self.tiles and layer=='height':
+            level = self.level_for_resolution(resolution)
+            if level>0:
+                x, y, z = self.overview(level)
+                cellsize = self.level_cellsize(level)
+                # the overview grid can overhang the tiles, so clip to them
+                xmin, xmax, ymin, ymax = self.extent()
+                inside = (xs>=xmin) & (xs<xmax) & (ys>=ymin) & (ys<ymax)
+                return np.where(inside, grid_interp(z, x[0], y[0], cellsize, xs, ys), np.nan)
+        zs = self._bucket_lookup(xs.ravel(), ys.ravel(),
+                                 lambda ii, x, y: self.tile_lookup(ii, x, y, layer))
+        return zs.reshape(xs.shape)
+
+    def _bucket_lookup(self,xs,ys,tile_lookup,skip=None):
+        """
+        Values at the points in 1-D arrays xs and ys, NaN where no tile
+        has one.  Points are grouped by index bucket so each tile in a
+        bucket, other than skip, gets one tile_lookup(ii,x,y) call.
+        """
+        zs = np.full(xs.shape, np.nan)
+        point_idx = np.flatnonzero(np.isfinite(xs) & np.isfinite(ys))
+        if point_idx.size==0:
+            return zs
+        bx = np.floor(xs[point_idx]/self.bucket_size).astype(np.int64)
+        by = np.floor(ys[point_idx]/self.bucket_size).astype(np.int64)
+        bx_min, by_min = bx.min(), by.min()
+        span = bx.max() - bx_min + 1
+        codes = (bx - bx_min) + span*(by - by_min)
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        starts = np.flatnonzero(np.diff(codes, prepend=-1))
+        for group, code in zip(np.split(point_idx[order], starts[1:]), codes[starts]):
+            key = (int(code % span + bx_min), int(code // span + by_min))
+            for ii in self._index.get(key, []):
+                if ii==skip:
+                    continue
+                todo = group[np.isnan(zs[group])]
+                if todo.size==0:
+                    break
+                zs[todo] = tile_lookup(ii, xs[todo], ys[todo])
+        return zs
+
+    def profile(self,x0,y0,x1,y1,spacing=None):
+        """
+        dists, zs = tile_collection.profile(x0,y0,x1,y1)
+
+        Terrain heights zs sampled at distances dists along the straight
+        line from (x0,y0) to (x1,y1), every spacing m (default the finest
+        tile spacing), including both ends.
+        """
+        if spacing is None:
+            spacing = self.level_cellsize(0) if self.tiles else 1.0
+        length = np.hypot(x1-x0, y1-y0)
+        num_points = int(np.ceil(length/spacing)) + 1
+        fracs = np.linspace(0.0, 1.0, num_points)
+        zs = self.lookup_many(x0 + fracs*(x1-x0), y0 + fracs*(y1-y0))
+        return fracs*length, zs
+
+    def path_clearance(self,x0,y0,alt0,x1,y1,alt1,spacing=None):
+        """
+        min_clearance, max_agl = tile_collection.path_clearance(x0,y0,alt0,x1,y1,alt1)
+
+        Straight path climbing or descending evenly from altitude alt0 at
+        (x0,y0) to alt1 at (x1,y1), all ASL.  Both are NaN if the path
+        is entirely off the map.
+        """
+        dists, zs = self.profile(x0,y0,x1,y1,spacing)
+        if np.all(np.isnan(zs)):
+            return np.nan, np.nan
+        path_alts = alt0 + (alt1-alt0)*dists/max(dists[-1], 1e-9)
+        heights_agl = path_alts - zs
+        return np.nanmin(heights_agl), np.nanmax(heights_agl)
+
+    def to_nparray(self, cellsize=None, bounds=None, keep_loaded=True):
         """
         x,y,z = tile_collection.to_nparray()
 
         x and y are 1-D vectors with the grid coordinates
-        z is a 2-D array with the terrain heights
-        """
-        # quick version for now, assuming same spacings
-        all_x = np.unique(np.concatenate([t.x for t in self.tiles]))
-        all_y = np.unique(np.concatenate([t.y for t in self.tiles]))
-        all_z = np.zeros((len(all_y),len(all_x)))
-        for t in self.tiles:
-            x_idx = [x in t.x for x in all_x]
-            y_idx = [y in t.y for y in all_y]
-            all_z[np.ix_(y_idx,x_idx)] = t.Z
+        z is a 2-D float32 array with the terrain heights, NaN in gaps
+
+        cellsize defaults to the finest tile spacing, and coarser or
+        misaligned tiles are resampled onto that grid.  bounds limits the
+        grid to (xmin, xmax, ymin, ymax).  With keep_loaded False, tiles
+        that were not already loaded are unloaded again once read, so the
+        tiles in use stay loaded.
+        """
+        if cellsize is None:
+            cellsize = min(t.cellsize for t in self.tiles)
+        if bounds is None:
+            bounds = self.extent()
+        xmin, xmax, ymin, ymax = bounds
+        x0 = np.floor(xmin/cellsize)*cellsize
+        y0 = np.floor(ymin/cellsize)*cellsize
+        all_x = x0 + cellsize*np.arange(int(np.ceil((xmax-x0)/cellsize)))
+        all_y = y0 + cellsize*np.arange(int(np.ceil((ymax-y0)/cellsize)))
+        all_z = np.full((len(all_y),len(all_x)), np.nan, dtype=np.float32)
+        # coarse tiles first so finer ones overwrite them
+        for ii in sorted(range(len(self.tiles)), key=lambda k: -self.tiles[k].cellsize):
+            t = self.tiles[ii]
+            txmin, txmax, tymin, tymax = t.extent()
+            # output cells whose grid points lie in this tile's footprint
+            c0, c1 = np.searchsorted(all_x, [txmin, txmax])
+            r0, r1 = np.searchsorted(all_y, [tymin, tymax])
+            if c0==c1 or r0==r1:
+                continue
+            # integer offsets into the tile for a decimating copy
+            step = cellsize/t.cellsize
+            col0 = (all_x[c0] - t.xllcorner)/t.cellsize
+            row0 = (all_y[r0] - t.yllcorner)/t.cellsize
+            # read while the tile cannot be evicted by another thread
+            with self._lock:
+                if keep_loaded:
+                    t = self.get_tile(ii)
+                else:
+                    # read it outside the LRU order
+                    t.load()
+                if all(np.isclose(v, np.round(v)) for v in (step, col0, row0)):
+                    step, col0, row0 = int(round(step)), int(round(col0)), int(round(row0))
+                    all_z[r0:r1,c0:c1] = t.Z[row0:row0+(r1-r0)*step:step,
+                                             col0:col0+(c1-c0)*step:step]
+                else:
+                    grid_x, grid_y = all_x[None,c0:c1], all_y[r0:r1,None]
+                    all_z[r0:r1,c0:c1] = self._seam_interp(ii, grid_x, grid_y,
+                                                           t.lookup(grid_x, grid_y),
+                                                           keep_loaded)
+                if ii not in self._resident:
+                    t.unload()
         return all_x, all_y, all_z
-    
-    def plot(self, ax=None):
+
+    def extent(self):
+        "(xmin, xmax, ymin, ymax) bounding all the tiles"
+        extents = np.array([t.extent() for t in self.tiles])
+        return (extents[:,0].min(), extents[:,1].max(),
+                extents[:,2].min(), extents[:,3].max())
+
+    def level_cellsize(self, level):
+        "Grid spacing of overview level, where level 0 is the finest tile data"
+        return min(t.cellsize for t in self.tiles)*2**level
+
+    def level_for_resolution(self, resolution):
+        "Coarsest overview level with spacing no larger than resolution"
+        level = 0
+        while self.level_cellsize(level+1)<=resolution:
+            level += 1
+        return level
+
+    def overview(self, level):
+        """
+        x,y,z = tile_collection.overview(level)
+
+        Mosaic of the whole collection decimated to level_cellsize(level),
+        built from the tiles on first use and kept for later queries.
+        Finer tiles take priority wherever they exist.  Overviews count
+        towards memory_limit along with the tiles.
+        """
+        with self._lock:
+            result = self._overviews.get(level)
+        if result is None:
+            print(f'Building terrain overview at {self.level_cellsize(level)}m')
+            result = self.to_nparray(cellsize=self.level_cellsize(level), keep_loaded=False)
+        with self._lock:
+            self._overviews[level] = result
+            self._overviews.move_to_end(level)
+            self._evict()
+        return result
+
+    def plot(self, ax=None, max_points=500):
         if ax is None:
             _, ax = plt.subplots(subplot_kw={"projection": "3d"})
-        x,y,z = self.to_nparray()
+        xmin, xmax, _, _ = self.extent()
+        x,y,z = self.overview(self.level_for_resolution((xmax-xmin)/max_points))
         xg,yg = np.meshgrid(x,y)
         ax.plot_surface(xg, yg, z)
         plt.show()
@@ -119,7 +697,7 @@ if __name__=='__main__':
     #tile = TerrainTile('map_data/Download_llanbedr_terrain_2297518/terrain-5-dtm_5107396/sh/SH52NE.asc')
     #tile.plot(ax=ax, show=False)
     # now test whole collection of tiles
-    tile_cltn = TerrainTileCollection('map_data/Download_llanbedr_terrain_2297518/terrain-5-dtm_5107396')
+    tile_cltn = TerrainTileCollection('map_data/Download_llanbedr_terrain_2297518')
     tile_cltn.plot()
     x_samp, y_samp = 258000, 322000
     z_samp = tile_cltn.lookup(x_samp,y_samp)
@@ -7,57 +7,127 @@ import argparse
 
 from math import sqrt, cos, sin, pi
 
-import pyproj
+import numpy as np
 
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.figure import Figure
 
-import rasterio
-from rasterio.plot import show
-
+from basemap import Basemap
 from terrain import TerrainTileCollection
+from viewshed import viewshed
 from drone_interface import DroneInterface
-from chat_client import ChatClient
+from chat_client import ChatClient, ChatWorker
+from coord_transform import CoordTransform
 
-crs_osgb = pyproj.CRS.from_epsg(27700)
-crs_gps = pyproj.CRS.from_epsg(4326)
-lat_lon_to_east_north = pyproj.Transformer.from_crs(crs_gps, crs_osgb)
-east_north_to_lat_lon = pyproj.Transformer.from_crs(crs_osgb, crs_gps)
+# shared by everything on the map, transformers built on first use
+coord_transform = CoordTransform()
 
 deg_to_rad = pi/180.0
 
-class MapTrack:
+viewshed_radius = 2000.0
+max_agl = 120.0
+min_path_clearance = 10.0
+# points kept per track, and how far simplified old points may stray in m
+track_retention = 5000
+track_tolerance = 2.0
+# map refresh period in ms, and seconds between viewshed updates
+frame_period_ms = 150
+viewshed_period = 1.0
+# wait for the view to settle before reading the basemap, and how much
+# extra to read round the view as a fraction of its size
+basemap_delay_ms = 200
+basemap_margin = 0.25
+# most chat messages shown per frame, so a backlog cannot stall the GUI
+chat_batch_size = 20
+
+def simplify_track(x, y, tolerance):
+    """
+    Douglas-Peucker line simplification of the points x,y
+    Returns a boolean mask of the points to keep, always including the ends
+    """
+    keep = np.zeros(len(x), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(x)-1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        # perpendicular distance of the points between from the chord
+        dx, dy = x[last]-x[first], y[last]-y[first]
+        chord = np.hypot(dx, dy)
+        px, py = x[first+1:last]-x[first], y[first+1:last]-y[first]
+        if chord > 0.0:
+            dists = np.abs(dx*py - dy*px)/chord
+        else:
+            dists = np.hypot(px, py)
+        worst = np.argmax(dists)
+        if dists[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
 
-    def __init__(self, name, parent_map, track_style='-', head_style='x'):
+class MapTrack:
+    """
+    Line of points on the map with a marker at the latest one.
+    Points are held in a preallocated array of max_points.  When it fills,
+    the older half is simplified to within tolerance metres, and if that
+    does not free enough room the oldest points are dropped.
+    """
+
+    def __init__(self, name, parent_map, track_style='-', head_style='x',
+                 max_points=track_retention, tolerance=track_tolerance):
         self.name = name
         self.parent_map = parent_map
-        self.track_line, = parent_map.ax.plot([],[],track_style)
-        self.head_marker, = parent_map.ax.plot([],[],head_style)
-        self.track_points = []
+        self.track_line, = parent_map.ax.plot([],[],track_style,animated=True)
+        self.head_marker, = parent_map.ax.plot([],[],head_style,animated=True)
+        self.tolerance = tolerance
+        # x in row 0 and y in row 1 so each is a contiguous view
+        self.points = np.empty((2, max(max_points, 4)))
+        self.num_points = 0
 
     def plot(self):
-        if self.track_points:
-            self.head_marker.set_data([self.track_points[-1][0]],[self.track_points[-1][1]])
+        if self.num_points:
+            self.head_marker.set_data(self.points[0,self.num_points-1:self.num_points],
+                                      self.points[1,self.num_points-1:self.num_points])
         else:
             self.head_marker.set_data([],[])
-        self.track_line.set_data([p[0] for p in self.track_points],
-                                 [p[1] for p in self.track_points])
+        self.track_line.set_data(self.points[0,:self.num_points],
+                                 self.points[1,:self.num_points])
 
     def update(self,x,y):
-        self.track_points.append((x,y))
+        if self.num_points==self.points.shape[1]:
+            self.compact()
+        self.points[:,self.num_points] = (x, y)
+        self.num_points += 1
         self.plot()
 
+    def compact(self):
+        "Make room by simplifying the older half of the track"
+        num_old = self.num_points//2
+        keep = simplify_track(self.points[0,:num_old], self.points[1,:num_old], self.tolerance)
+        num_kept = np.count_nonzero(keep)
+        if num_kept > num_old//2:
+            # too wiggly to simplify much, so forget the oldest instead
+            keep[:] = False
+            keep[num_old//2:] = True
+            num_kept = num_old - num_old//2
+        self.points[:,:num_kept] = self.points[:,:num_old][:,keep]
+        self.points[:,num_kept:num_kept+self.num_points-num_old] = self.points[:,num_old:self.num_points]
+        self.num_points -= num_old - num_kept
+
     def wipe(self):
-        self.track_points.clear()
+        self.num_points = 0
         self.plot()
 
     def update_latlon(self,lat,lon):
-        x,y = lat_lon_to_east_north.transform(lat, lon)
+        x,y = coord_transform.to_east_north(lat, lon)
         self.update(x,y)
 
     def get_current_pos(self):
-        if self.track_points:
-            return(self.track_points[-1])
+        if self.num_points:
+            return (self.points[0,self.num_points-1], self.points[1,self.num_points-1])
 
 class RingedTrack(MapTrack):
 
@@ -68,12 +138,12 @@ class RingedTrack(MapTrack):
 
     def add_ring(self, radius, line_style='-'):
         self.radii.append(radius)
-        new_ring, = self.parent_map.ax.plot([],[],line_style)
+        new_ring, = self.parent_map.ax.plot([],[],line_style,animated=True)
         self.ring_lines.append(new_ring)
 
     def plot(self):
         super().plot()
-        if self.track_points:
+        if self.num_points:
             angles = [2*pi*kk/100 for kk in range(100)] + [0]
             num_rings = len(self.radii)
             for ii in range(num_rings):
@@ -82,16 +152,107 @@ class RingedTrack(MapTrack):
                 ring_y = [ctr_y + self.radii[ii]*sin(a) for a in angles]
                 self.ring_lines[ii].set_data(ring_x, ring_y)
 
-class TkTrackerMap(FigureCanvasTkAgg):
+class MapOverlay:
 
-    def __init__(self, master, tile_file_name):
+    def __init__(self, parent_map, color=(0.,0.,1.), alpha=0.3):
+        self.parent_map = parent_map
+        self.color = color
+        self.alpha = alpha
+        self.image = parent_map.ax.imshow(np.zeros((1,1,4)), origin='lower', extent=(0,1,0,1),
+                                          animated=True)
+
+    def update(self, x, y, mask):
+        "Shade the cells where mask is True on the grid x,y"
+        rgba = np.zeros(mask.shape + (4,))
+        rgba[...,:3] = self.color
+        rgba[...,3] = self.alpha*mask
+        half_cell = 0.5*(x[1]-x[0])
+        self.image.set_data(rgba)
+        self.image.set_extent((x[0]-half_cell, x[-1]+half_cell,
+                               y[0]-half_cell, y[-1]+half_cell))
+
+    def wipe(self):
+        self.image.set_data(np.zeros((1,1,4)))
+
+class BlitCanvas(FigureCanvasTkAgg):
+    """
+    Canvas that keeps an image of everything except its animated artists,
+    so refresh() only has to paint those on top.  The background is
+    grabbed whenever the figure is fully drawn, e.g. after pan, zoom
+    or resize.
+    """
+
+    def __init__(self, figure, master):
+        super().__init__(figure, master=master)
+        self.background = None
+        self.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.copy_from_bbox(self.figure.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for ax in self.figure.axes:
+            for artist in sorted((a for a in ax.get_children() if a.get_animated()),
+                                 key=lambda a: a.get_zorder()):
+                ax.draw_artist(artist)
+
+    def refresh(self):
+        "Redraw just the animated artists over the saved background"
+        if self.background is None:
+            self.draw()
+            return
+        self.restore_region(self.background)
+        self.draw_animated()
+        self.blit(self.figure.bbox)
+
+class TkTrackerMap(BlitCanvas):
+
+    def __init__(self, master, tile_path):
         fig = Figure(figsize=(5, 5), dpi=100)
-        super().__init__(fig,master=master)
+        super().__init__(fig,master)
         self.ax = fig.add_subplot()
-        base_map = rasterio.open(tile_file_name)
-        show(base_map, ax=self.ax)
-        self.tile_limits = self.ax.axis()
+        # basemap is read for the current view only, at screen resolution
+        self.basemap = Basemap(tile_path)
+        self.tile_limits = self.basemap.extent()
+        self.base_image = self.ax.imshow(np.zeros((1,1,4), dtype=np.uint8),
+                                         extent=self.tile_limits)
+        self.ax.axis(self.tile_limits)
+        # overlays must not rescale the map
+        self.ax.set_autoscale_on(False)
         fig.tight_layout()
+        self.loaded_view = None
+        self.basemap_pending = False
+        self.ax.callbacks.connect('xlim_changed', self.view_changed)
+        self.ax.callbacks.connect('ylim_changed', self.view_changed)
+        self.mpl_connect('resize_event', self.view_changed)
+        self.update_basemap()
+
+    def view_changed(self, *args):
+        "Pan, zoom or resize, so read the basemap again once it settles"
+        if not self.basemap_pending:
+            self.basemap_pending = True
+            self.get_tk_widget().after(basemap_delay_ms, self.update_basemap)
+
+    def update_basemap(self):
+        self.basemap_pending = False
+        xmin, xmax = self.ax.get_xlim()
+        ymin, ymax = self.ax.get_ylim()
+        width, height = int(self.ax.bbox.width), int(self.ax.bbox.height)
+        view = (xmin, xmax, ymin, ymax, width, height)
+        if width < 1 or height < 1 or view==self.loaded_view:
+            return
+        self.loaded_view = view
+        # a margin round the view so short pans do not show blank edges
+        x_margin = basemap_margin*(xmax - xmin)
+        y_margin = basemap_margin*(ymax - ymin)
+        bounds = (xmin-x_margin, xmax+x_margin, ymin-y_margin, ymax+y_margin)
+        rgba = self.basemap.read(bounds,
+                                 int(width*(1+2*basemap_margin)),
+                                 int(height*(1+2*basemap_margin)))
+        self.base_image.set_data(rgba)
+        self.base_image.set_extent(bounds)
+        self.draw_idle()
 
     def add_track(self,name, track_style='-', head_style='x', track_type=MapTrack):
         new_track = track_type(name, self, track_style, head_style)
@@ -121,6 +282,14 @@ class TrackerToolbar(tkinter.Frame):
                                              text='CAN',
                                              command=parent_app.cancel_fly_to)
         self.buttons['CAN'].grid(row=0,column=6)
+        self.buttons['VIS'] = tkinter.Button(master=self,
+                                             text='VIS',
+                                             command=parent_app.toggle_viewshed)
+        self.buttons['VIS'].grid(row=0,column=7)
+        self.buttons['SEL'] = tkinter.Button(master=self,
+                                             text='SEL',
+                                             command=parent_app.select_next_drone)
+        self.buttons['SEL'].grid(row=0,column=8)
 
 class TrackerMapNavToolbar(NavigationToolbar2Tk):
 
@@ -151,9 +320,9 @@ class AltMarker:
         self.alt_line = None
         self.alt_mark = None
         if line_style:
-            self.alt_line, = parent_tape.ax.plot([],[],line_style)
+            self.alt_line, = parent_tape.ax.plot([],[],line_style,animated=True)
         if marker_style:
-            self.alt_mark, = parent_tape.ax.plot([],[],marker_style)
+            self.alt_mark, = parent_tape.ax.plot([],[],marker_style,animated=True)
 
     def plot(self):
         if self.alt is not None:
@@ -171,11 +340,11 @@ class AltMarker:
         self.plot()
 
 
-class AltTape(FigureCanvasTkAgg):
+class AltTape(BlitCanvas):
 
     def __init__(self, master):
         fig = Figure(figsize=(1, 5), dpi=100)
-        super().__init__(fig,master=master)
+        super().__init__(fig,master)
         self.ax = fig.add_subplot()
         self.ax.axis([-0.5,0.5,-50,200])
         self.ax.set_xticks([])
@@ -194,9 +363,9 @@ class TimeMarker:
         self.time_line = None
         self.time_mark = None
         if line_style:
-            self.time_line, = parent_tape.ax.plot([],[],line_style)
+            self.time_line, = parent_tape.ax.plot([],[],line_style,animated=True)
         if marker_style:
-            self.time_mark, = parent_tape.ax.plot([],[],marker_style)
+            self.time_mark, = parent_tape.ax.plot([],[],marker_style,animated=True)
 
     def plot(self):
         if self.time_secs is not None:
@@ -217,13 +386,17 @@ class TimeMarker:
         self.update_time(time.time()+offset)
         self.plot()
 
-class TimeTape(FigureCanvasTkAgg):
+class TimeTape(BlitCanvas):
 
-    def __init__(self, master):
+    def __init__(self, master, full_redraw_period=15.0):
         fig = Figure(figsize=(5, 1), dpi=100)
-        super().__init__(fig,master=master)
+        super().__init__(fig,master)
         self.ax = fig.add_subplot()
         self.time_range = [-3600,3600]
+        # the axis scrolls under a pixel in this time, so markers are
+        # blitted in between full redraws
+        self.full_redraw_period = full_redraw_period
+        self.last_full_draw = None
         self.ax.axis([self.time_range[0],self.time_range[1],-0.5,0.5])
         #fig.autofmt_xdate()
         fig.tight_layout()
@@ -234,6 +407,10 @@ class TimeTape(FigureCanvasTkAgg):
 
     def draw_now(self):
         time_now = time.time()
+        if self.last_full_draw and time_now < self.last_full_draw + self.full_redraw_period:
+            self.refresh()
+            return
+        self.last_full_draw = time_now
         # lots of work to label the axis intuitively
         str_now = time.localtime()
         first_tick = time.mktime((str_now.tm_year, str_now.tm_mon, str_now.tm_mday,
@@ -254,9 +431,36 @@ def distance(p1,p2):
     x2,y2 = p2
     return sqrt((x1-x2)*(x1-x2) + (y1-y2)*(y1-y2))
 
+drone_colours = ['b','r','c','m','y','k']
+
+class DroneDisplay:
+    "Map tracks and tape markers for one vehicle"
+
+    def __init__(self, system_id, colour, tracker_map, alt_tape, time_tape):
+        self.system_id = system_id
+        self.tracks = {}
+        self.tracks['DRONE'] = tracker_map.add_track(f'Drone{system_id}',head_style=colour+'x',track_style=colour+'-')
+        self.tracks['TARGET'] = tracker_map.add_track(f'Target{system_id}', track_style='', head_style=colour+'d')
+        self.tracks['TAKEOFF'] = tracker_map.add_track(f'Takeoff{system_id}',head_style=colour+'s',track_style=colour+'s')
+        self.tracks['SENSOR'] = tracker_map.add_track(f'Sensor{system_id}',head_style='go',track_style='g-')
+        self.tracks['SENSOR'].track_line.set_lw(10)
+        self.tracks['SENSOR'].track_line.set_c((0.,1.,0.,0.5))
+        self.alt_marks = {}
+        self.alt_marks['DRONE'] = alt_tape.add_marker(line_style=None, marker_style=colour+'x')
+        self.alt_marks['TARGET'] = alt_tape.add_marker(colour+'--d',None)
+        self.alt_marks['TAKEOFF'] = alt_tape.add_marker(line_style=None, marker_style=colour+'s')
+        # marker colours keep their meaning, line colour shows the vehicle
+        self.time_markers = {'TAKEOFF': time_tape.add_marker(line_style=colour+'-',marker_style=None),
+                             'TURNBATT': time_tape.add_marker(line_style=colour+'-',marker_style='ys'),
+                             'TURNTIME': time_tape.add_marker(line_style=colour+'-',marker_style='yo'),
+                             'BATTERY': time_tape.add_marker(line_style=colour+'-',marker_style='rs'),
+                             'ENDURANCE': time_tape.add_marker(line_style=colour+'-',marker_style='ro'),}
+
 class TrackerApp:
 
-    def __init__(self, tile_file_name, mav_connect_str, chat_url, terrain_path):
+    def __init__(self, tile_file_name, mav_connect_str, chat_url, terrain_path,
+                 terrain_memory_mb=None, terrain_workers=0, telemetry_log=None, chat_mode='stream',
+                 terrain_layers=False):
         print('Starting...')
         # make the app
         self.root = tkinter.Tk()
@@ -300,32 +504,34 @@ class TrackerApp:
         self.alt_tape.mpl_connect("button_press_event", self.alt_click_handler)
         # timeline
         self.time_tape = TimeTape(self.btmbar)
-        self.time_markers = {'NOW': self.time_tape.add_marker(line_style='k-',marker_style=None),
-                             'TAKEOFF': self.time_tape.add_marker(line_style='b-',marker_style=None),
-                             'TURNBATT': self.time_tape.add_marker(line_style='y-',marker_style='ys'),
-                             'TURNTIME': self.time_tape.add_marker(line_style='y-',marker_style='yo'),
-                             'BATTERY': self.time_tape.add_marker(line_style='r-',marker_style='rs'),
-                             'ENDURANCE': self.time_tape.add_marker(line_style='r-',marker_style='ro'),}
+        self.time_markers = {'NOW': self.time_tape.add_marker(line_style='k-',marker_style=None)}
         # connect to the MAV
-        self.mav = DroneInterface(mav_connect_str)
-        # add loads of tracking for the drone
-        self.tracks['DRONE'] = self.tracker_map.add_track('Drone',head_style='bx',track_style='b-')
-        self.tracks['TARGET'] = self.tracker_map.add_track('TARGET', track_style='', head_style='bd')
-        self.tracks['TAKEOFF'] = self.tracker_map.add_track('Takeoff',head_style='bs',track_style='bs')
-        self.tracks['SENSOR'] = self.tracker_map.add_track('Sensor',head_style='go',track_style='g-')
-        self.tracks['SENSOR'].track_line.set_lw(10)
-        self.tracks['SENSOR'].track_line.set_c((0.,1.,0.,0.5))
-        self.alt_marks['DRONE'] = self.alt_tape.add_marker(line_style=None, marker_style='bx')
-        self.alt_marks['TARGET'] = self.alt_tape.add_marker('b--d',None)
-        self.alt_marks['TAKEOFF'] = self.alt_tape.add_marker(line_style=None, marker_style='bs')
+        self.mav = DroneInterface(mav_connect_str, log_file=telemetry_log)
+        # tracks and markers for each vehicle added as they appear
+        self.drones = {}
+        self.selected_drone = None
+        # terrain marks follow the selected drone
         self.alt_marks['TERRAIN'] = self.alt_tape.add_marker(line_style='g-', marker_style=None)
         self.alt_marks['MAX'] = self.alt_tape.add_marker('r-',None)
         # connect to chat server
-        self.chat_client = None
+        self.chat_worker = None
         if chat_url:
-            self.chat_client = ChatClient(chat_url)
+            # fetched in the background and queued for the GUI
+            self.chat_worker = ChatWorker(ChatClient(chat_url), mode=chat_mode)
+        # shading of ground visible from the drone
+        self.viewshed = MapOverlay(self.tracker_map)
+        self.show_viewshed = False
+        self.viewshed_time = 0.0
         # load terrain
-        self.terrain = TerrainTileCollection(terrain_path)
+        terrain_memory = None
+        if terrain_memory_mb:
+            terrain_memory = terrain_memory_mb*1024*1024
+        self.terrain = TerrainTileCollection(terrain_path, memory_limit=terrain_memory)
+        if terrain_workers:
+            self.terrain.build_caches(max_workers=terrain_workers)
+        if terrain_layers:
+            # walks every tile, so only when asked for
+            self.terrain.build_layers_in_background()
         # assemble GUI
         self.nav_toolbar.pack(side=tkinter.LEFT)
         self.track_toolbar.pack(side=tkinter.LEFT)
@@ -354,6 +560,8 @@ class TrackerApp:
             self.nav_toolbar.disable()
         # make the chosen mode green
         for btn in self.track_toolbar.buttons:
+            if btn in ('VIS','SEL'):
+                continue
             if btn==new_mode:
                 self.track_toolbar.buttons[btn].configure(bg="LimeGreen")
             else:
@@ -365,34 +573,121 @@ class TrackerApp:
         self.tracks[new_poi] = self.tracker_map.add_track(new_poi, head_style='b^')
         self.tracks[new_poi].update(x,y)
 
+    def add_drone(self,system_id):
+        colour = drone_colours[len(self.drones) % len(drone_colours)]
+        new_drone = DroneDisplay(system_id, colour, self.tracker_map, self.alt_tape, self.time_tape)
+        self.drones[system_id] = new_drone
+        for name, track in new_drone.tracks.items():
+            self.tracks[f'{name}{system_id}'] = track
+        if self.selected_drone is None:
+            self.select_drone(system_id)
+
+    def select_drone(self,system_id):
+        self.selected_drone = system_id
+        self.track_toolbar.buttons['SEL'].configure(text=f'#{system_id}')
+
+    def select_next_drone(self):
+        drone_ids = list(self.drones)
+        if drone_ids:
+            if self.selected_drone in drone_ids:
+                next_idx = (drone_ids.index(self.selected_drone)+1) % len(drone_ids)
+            else:
+                next_idx = 0
+            self.select_drone(drone_ids[next_idx])
+
+    def selected_display(self):
+        "DroneDisplay of the vehicle commanded by FLY, HOV etc, or None"
+        return self.drones.get(self.selected_drone)
+
     def fly_to(self,x,y,asl,yaw_rate):
-        self.tracks['TARGET'].wipe()
-        self.tracks['TARGET'].update(x,y)
-        self.alt_marks['TARGET'].update_alt(asl)
-        lat, lon = east_north_to_lat_lon.transform(x,y)
-        self.mav.set_target(lat,lon,asl,yaw_rate)
+        drone = self.selected_display()
+        if drone is None:
+            return
+        drone.tracks['TARGET'].wipe()
+        drone.tracks['TARGET'].update(x,y)
+        drone.alt_marks['TARGET'].update_alt(asl)
+        lat, lon = coord_transform.to_lat_lon(x,y)
+        self.mav.set_target(lat,lon,asl,yaw_rate,system_id=drone.system_id)
 
     def hover(self, yaw_rate=0.0):
-        x,y = self.tracks['DRONE'].get_current_pos()
-        asl = self.alt_marks['DRONE'].alt
+        drone = self.selected_display()
+        if drone is None or drone.tracks['DRONE'].get_current_pos() is None:
+            return
+        x,y = drone.tracks['DRONE'].get_current_pos()
+        asl = drone.alt_marks['DRONE'].alt
         self.fly_to(x,y,asl,yaw_rate)
 
     def circle(self, yaw_rate=0.25):
         self.hover(yaw_rate=yaw_rate)
 
+    def check_fly_path(self,x,y,asl):
+        """
+        ok, msg = app.check_fly_path(x,y,asl)
+
+        Check the straight path from the drone to a target at (x,y,asl)
+        against the terrain.  ok is False if the path comes within
+        min_path_clearance of the ground, or there is no target altitude.  Going above max_agl only warns.
+        """
+        if asl is None:
+            # nothing could be sent, so there is no path to check
+            return False, 'Path REFUSED:\nno target altitude'
+        drone = self.selected_display()
+        if drone is None:
+            return True, 'Path not checked:\nno drone'
+        start_pos = drone.tracks['DRONE'].get_current_pos()
+        start_asl = drone.alt_marks['DRONE'].alt
+        if start_pos is None or start_asl is None:
+            return True, 'Path not checked'
+        clearance, agl = self.terrain.path_clearance(start_pos[0], start_pos[1], start_asl,
+                                                     x, y, asl)
+        if np.isnan(clearance):
+            return True, 'Path not checked:\nno terrain data'
+        if clearance<min_path_clearance:
+            return False, f'Path REFUSED:\nclearance {clearance:.0f}m'
+        if agl>max_agl:
+            return True, f'Path WARNING:\n{agl:.0f}m AGL max'
+        return True, f'Path clear {clearance:.0f}m,\n{agl:.0f}m AGL max'
+
     def cancel_fly_to(self):
-        self.tracks['TARGET'].wipe()
-        self.mav.clear_target()
+        drone = self.selected_display()
+        if drone:
+            drone.tracks['TARGET'].wipe()
+            self.mav.clear_target(system_id=drone.system_id)
+
+    def toggle_viewshed(self):
+        self.show_viewshed = not self.show_viewshed
+        if self.show_viewshed:
+            self.track_toolbar.buttons['VIS'].configure(bg="LimeGreen")
+        else:
+            self.track_toolbar.buttons['VIS'].configure(bg="light gray")
+            self.viewshed.wipe()
+
+    def target_alt(self):
+        "Target altitude set on the tape for the selected drone"
+        drone = self.selected_display()
+        if drone:
+            return drone.alt_marks['TARGET'].alt
 
     def alt_click_handler(self,e):
-        self.alt_marks['TARGET'].update_alt(e.ydata)
-        self.alt_tape.draw()
-        current_target = self.mav.get_target()
+        drone = self.selected_display()
+        if drone is None:
+            return
+        current_target = self.mav.get_target(system_id=drone.system_id)
+        if current_target:
+            # the new altitude changes the path, so check it like a FLY click
+            x, y = coord_transform.to_east_north(current_target[0], current_target[1])
+            path_ok, path_msg = self.check_fly_path(x, y, e.ydata)
+            self.status_msgs.set(path_msg)
+            if not path_ok:
+                return
+        drone.alt_marks['TARGET'].update_alt(e.ydata)
+        self.alt_tape.refresh()
         if current_target:
             self.mav.set_target(current_target[0],
                                 current_target[1],
                                 e.ydata,
-                                current_target[3])
+                                current_target[3],
+                                system_id=drone.system_id)
 
     def click_handler(self,e):
         if self.click_mode=='MISPER':
@@ -400,9 +695,12 @@ class TrackerApp:
         elif self.click_mode=='POI':
             self.add_poi(e.xdata, e.ydata)
         elif self.click_mode=='FLY':
-            self.fly_to(e.xdata,e.ydata,self.alt_marks['TARGET'].alt, 0.0)
-            self.set_click_mode('NAV')
-        self.tracker_map.draw()
+            path_ok, path_msg = self.check_fly_path(e.xdata,e.ydata,self.target_alt())
+            self.status_msgs.set(path_msg)
+            if path_ok:
+                self.fly_to(e.xdata,e.ydata,self.target_alt(), 0.0)
+                self.set_click_mode('NAV')
+        self.tracker_map.refresh()
 
     def update_distances(self,cursor_pos):
         self.dist_box.delete(0,self.dist_box.size())
@@ -413,113 +711,174 @@ class TrackerApp:
 
     def hover_handler(self, e):
         if e.xdata:
-            lat, lon = east_north_to_lat_lon.transform(e.xdata, e.ydata)
+            lat, lon = coord_transform.to_lat_lon(e.xdata, e.ydata)
             terrain_alt = self.terrain.lookup(e.xdata, e.ydata)
-            self.status_msgs.set(f'{lat:.6f},\n{lon:.6f},\n{terrain_alt:.1f}m ASL')
+            terrain_msg = f'{terrain_alt:.1f}m ASL'
+            # slope only once computed in the background
+            if self.terrain.layers_ready.is_set():
+                terrain_slope = self.terrain.lookup(e.xdata, e.ydata, layer='slope')
+                terrain_msg += f', {terrain_slope:.0f}deg slope'
+            if self.click_mode=='FLY':
+                # live check of the path to a target here
+                _, path_msg = self.check_fly_path(e.xdata, e.ydata, self.target_alt())
+                self.status_msgs.set(f'{path_msg},\n{terrain_msg}')
+            else:
+                self.status_msgs.set(f'{lat:.6f},\n{lon:.6f},\n{terrain_msg}')
             self.update_distances((e.xdata, e.ydata))
         else:
             self.status_msgs.set('Cursor off map')
 
     def process_chat(self):
-        if self.chat_client:
-            messages = self.chat_client.get_new_messages()
+        if self.chat_worker:
+            messages = self.chat_worker.get_batch(chat_batch_size)
             for msg in messages:
                 chat_summary = f'[{msg.format_time()}] {msg.sender}: {msg.text}'
                 self.chat_box.insert(tkinter.END,chat_summary)
                 self.chat_box.see(tkinter.END)
-                if msg.has_location:
+            # convert all the locations in one go
+            located = [msg for msg in messages if msg.has_location()]
+            if located:
+                xs, ys = coord_transform.to_east_north([msg.lat for msg in located],
+                                                       [msg.lon for msg in located])
+                for msg, x, y in zip(located, xs, ys):
                     chat_track = msg.sender.upper()
                     if chat_track not in self.tracks:
                         self.tracks[chat_track] = self.tracker_map.add_track(chat_track, head_style='m^')
-                    self.tracks[chat_track].update_latlon(msg.lat, msg.lon)
-
-    def drone_update(self):
-        if self.mav.connected:
-            self.mav.process_mavlink()
+                    self.tracks[chat_track].update(x, y)
 
     def draw_drone(self):
-        if self.mav.has_position():
-            lat, lon = self.mav.current_lat_lon()
-            self.tracks['DRONE'].update_latlon(lat,lon)
-            alt_asl = self.mav.current_alt_asl()
-            self.alt_marks['DRONE'].update_alt(alt_asl)
+        positions = {}
+        # one snapshot, as the reader thread may add vehicles meanwhile
+        ids = self.mav.vehicle_ids()
+        for system_id in ids:
+            if system_id not in self.drones:
+                self.add_drone(system_id)
+            if self.mav.has_position(system_id):
+                positions[system_id] = self.mav.current_lat_lon(system_id)
+        # convert every vehicle position in one go
+        if positions:
+            lats, lons = zip(*positions.values())
+            xs, ys = coord_transform.to_east_north(lats, lons)
+            positions = dict(zip(positions, zip(xs, ys)))
+        for system_id in ids:
+            self.draw_vehicle(self.drones[system_id], positions.get(system_id))
+
+    def draw_vehicle(self, drone, position=None):
+        system_id = drone.system_id
+        selected = (system_id==self.selected_drone)
+        if position:
+            drone.tracks['DRONE'].update(*position)
+            alt_asl = self.mav.current_alt_asl(system_id)
+            drone.alt_marks['DRONE'].update_alt(alt_asl)
             # look up terrain height at drone location
-            drone_x, drone_y = self.tracks['DRONE'].get_current_pos()
+            drone_x, drone_y = drone.tracks['DRONE'].get_current_pos()
             terrain_under_drone = self.terrain.lookup(drone_x, drone_y)
-            self.alt_marks['TERRAIN'].update_alt(terrain_under_drone)
-            self.alt_marks['MAX'].update_alt(terrain_under_drone+120.0)
+            if selected:
+                self.alt_marks['TERRAIN'].update_alt(terrain_under_drone)
+                self.alt_marks['MAX'].update_alt(terrain_under_drone+max_agl)
+            # shade the ground in view of the drone
+            if (selected and self.show_viewshed and self.terrain.tiles
+                    and time.time() > self.viewshed_time + viewshed_period):
+                self.viewshed_time = time.time()
+                vis_x, vis_y, visible = viewshed(self.terrain, drone_x, drone_y,
+                                                 alt_asl, viewshed_radius)
+                self.viewshed.update(vis_x, vis_y, visible)
             # plot the sensor footprint
-            if self.mav.in_air():
+            if self.mav.in_air(system_id):
                 sensor_offset = 1.0*(alt_asl - terrain_under_drone)
-                sensor_x = drone_x + sensor_offset*sin(self.mav.current_hdg_deg()*deg_to_rad)
-                sensor_y = drone_y + sensor_offset*cos(self.mav.current_hdg_deg()*deg_to_rad)
-                self.tracks['SENSOR'].update(sensor_x,sensor_y)
+                sensor_x = drone_x + sensor_offset*sin(self.mav.current_hdg_deg(system_id)*deg_to_rad)
+                sensor_y = drone_y + sensor_offset*cos(self.mav.current_hdg_deg(system_id)*deg_to_rad)
+                drone.tracks['SENSOR'].update(sensor_x,sensor_y)
             # if takeoff time and loc also known
-            if self.mav.takeoff_time:
-                if not self.alt_marks['TAKEOFF'].alt:
-                    self.alt_marks['TAKEOFF'].update_alt(self.mav.takeoff_alt_asl())
-                    self.alt_marks['TARGET'].update_alt(self.mav.takeoff_alt_asl() + 20.0)
-                    to_lat, to_lon = self.mav.takeoff_lat_lon()
-                    self.tracks['TAKEOFF'].update_latlon(to_lat,to_lon)
-                    self.time_markers['TAKEOFF'].update_time(self.mav.takeoff_time)
-                    self.time_markers['ENDURANCE'].update_time(self.mav.takeoff_time+self.mav.endurance())
+            takeoff_time = self.mav.takeoff_time(system_id)
+            if takeoff_time:
+                if not drone.alt_marks['TAKEOFF'].alt:
+                    drone.alt_marks['TAKEOFF'].update_alt(self.mav.takeoff_alt_asl(system_id))
+                    drone.alt_marks['TARGET'].update_alt(self.mav.takeoff_alt_asl(system_id) + 20.0)
+                    to_lat, to_lon = self.mav.takeoff_lat_lon(system_id)
+                    drone.tracks['TAKEOFF'].update_latlon(to_lat,to_lon)
+                    drone.time_markers['TAKEOFF'].update_time(takeoff_time)
+                # endurance is re-estimated as the battery is used
+                endurance = self.mav.endurance(system_id)
+                drone.time_markers['ENDURANCE'].update_time(takeoff_time+endurance)
                 # plot turnback time
                 dist_home = distance((drone_x,drone_y),
-                                     self.tracks['TAKEOFF'].get_current_pos())
-                time_home = dist_home/self.mav.speed()
-                turnback_time = self.mav.takeoff_time+self.mav.endurance()-time_home
-                self.time_markers['TURNTIME'].update_time(turnback_time)
-        # battery estimate is dependent only on current battery message
-        battery_estimate = self.mav.battery_time_remaining(30)
+                                     drone.tracks['TAKEOFF'].get_current_pos())
+                time_home = dist_home/self.mav.speed(system_id)
+                turnback_time = takeoff_time+endurance-time_home
+                drone.time_markers['TURNTIME'].update_time(turnback_time)
+        # battery estimate is smoothed over the battery history
+        battery_estimate = self.mav.battery_time_remaining(30, system_id=system_id)
         if battery_estimate:
-            if self.time_markers['BATTERY'].time_secs:
-                if time.time() + battery_estimate < self.time_markers['BATTERY'].time_secs:
-                    self.time_markers['BATTERY'].update_now(battery_estimate)
-            else:
-                self.time_markers['BATTERY'].update_now(battery_estimate)
-
-
-
-    def fast_loop(self):
-        self.drone_update()
-        self.root.after(1, self.fast_loop)
+            drone.time_markers['BATTERY'].update_now(battery_estimate)
 
     def slow_loop(self):
-        # process chat
-        self.process_chat()
-        # process drone
-        self.draw_drone()
-        # redraw the canvas every second
-        self.tracker_map.draw()
-        self.alt_tape.draw()
         self.time_markers['NOW'].update_time(time.time())
         self.time_tape.draw_now()
-        # update target if there is one
-        if self.mav.connected:
-            self.mav.send_target()
         self.root.after(500, self.slow_loop)
 
+    def frame_loop(self):
+        # show chat as soon as it is queued
+        self.process_chat()
+        # process drone, redrawing only what moves
+        self.draw_drone()
+        self.tracker_map.refresh()
+        self.alt_tape.refresh()
+        self.root.after(frame_period_ms, self.frame_loop)
+
     def run(self):
+        # telemetry arrives on its own thread
+        self.mav.start()
+        if self.chat_worker:
+            self.chat_worker.start()
         self.slow_loop()
-        self.fast_loop()
+        self.frame_loop()
         self.root.mainloop()
+        self.mav.stop()
+        if self.chat_worker:
+            self.chat_worker.stop()
+        if self.mav.connected:
+            print(self.mav.command_report())
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--tile_file',
-                        help='Path to GeoTIFF file for basemap',
+                        help='Path to GeoTIFF file for basemap, or a directory of tiles to mosaic',
                         default='map_data/llanbedr_rgb.tif')
     parser.add_argument('-c', '--connect',
-                        help='Connection string e.g. tcp:localhost:14550',
+                        help='Connection string e.g. tcp:localhost:14550, or replay:flight.tlog?speed=4&start=60',
+                        default=None)
+    parser.add_argument('-l','--log',
+                        help='Record all telemetry to this tlog file',
                         default=None)
     parser.add_argument('-s','--server',
                         help='URL for chat server e.g. https://127.0.0.1:5000',
                         default=None)
+    parser.add_argument('--chat_mode',
+                        help='Get chat by server push (stream), long-polling, or polling every 500ms, all in the background',
+                        choices=['stream','longpoll','poll'],
+                        default='stream')
     parser.add_argument('-p','--path_to_terrain',
                         help='Path to search for terrain files',
-                        default='map_data/Download_llanbedr_terrain_2297518/terrain-5-dtm_5107396')
+                        default='map_data/Download_llanbedr_terrain_2297518')
+    parser.add_argument('--terrain_memory',
+                        help='Memory budget for loaded terrain tiles in MB',
+                        type=float,
+                        default=512)
+    parser.add_argument('--terrain_workers',
+                        help='Processes for converting terrain tiles at startup, 0 to convert on first use',
+                        type=int,
+                        default=0)
+    parser.add_argument('--terrain_layers',
+                        help='Compute slope, aspect and roughness for every tile in the background, to show slope under the cursor',
+                        action='store_true')
     args = parser.parse_args()
-    app = TrackerApp(args.tile_file, args.connect, args.server, args.path_to_terrain)
+    app = TrackerApp(args.tile_file, args.connect, args.server, args.path_to_terrain,
+                     terrain_memory_mb=args.terrain_memory,
+                     terrain_workers=args.terrain_workers,
+                     telemetry_log=args.log,
+                     chat_mode=args.chat_mode,
+                     terrain_layers=args.terrain_layers)
     app.run()
 
 
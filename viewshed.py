@@ -0,0 +1,58 @@
+import numpy as np
+
+def viewshed(terrain, x0, y0, observer_asl, radius, cellsize=None, target_height=0.0):
+    """
+    x,y,visible = viewshed(terrain, x0, y0, observer_asl, radius)
+
+    terrain is a TerrainTileCollection
+    x and y are 1-D vectors with the grid coordinates
+    visible is a 2-D boolean array, True where a point target_height
+    above the ground can be seen from the observer at (x0,y0,observer_asl)
+
+    Rays are cast out from the observer one per cell of the outer ring and
+    marched one cell at a time, all as array operations.  A point is seen
+    if its elevation angle is at least that of every point nearer along
+    its ray.  Cells off the map, or beyond radius, are not visible.
+    """
+    if cellsize is None:
+        cellsize = terrain.level_cellsize(0)
+    x, y, z = terrain.to_nparray(cellsize=cellsize,
+                                 bounds=(x0-radius, x0+radius, y0-radius, y0+radius))
+    # sample the heights along every ray by nearest grid point
+    num_steps = max(int(np.ceil(radius/cellsize)), 1)
+    num_rays = max(int(np.ceil(2*np.pi*radius/cellsize)), 8)
+    dists = cellsize*np.arange(1, num_steps+1)
+    angles = 2*np.pi*np.arange(num_rays)/num_rays
+    ray_x = x0 + np.sin(angles)[:,None]*dists[None,:]
+    ray_y = y0 + np.cos(angles)[:,None]*dists[None,:]
+    cols = np.clip(np.rint((ray_x - x[0])/cellsize).astype(int), 0, len(x)-1)
+    rows = np.clip(np.rint((ray_y - y[0])/cellsize).astype(int), 0, len(y)-1)
+    ray_z = z[rows,cols]
+    # tangent of elevation angle of the ground and of the target
+    ground_slope = (ray_z - observer_asl)/dists
+    target_slope = (ray_z + target_height - observer_asl)/dists
+    # steepest ground nearer along each ray, ignoring gaps in the data
+    horizon = np.fmax.accumulate(ground_slope, axis=1)
+    horizon = np.concatenate((np.full((num_rays,1), -np.inf), horizon[:,:-1]), axis=1)
+    ray_visible = (target_slope>=horizon) & ~np.isnan(ray_z)
+    # map each grid cell back onto its nearest ray sample
+    dx = x[None,:] - x0
+    dy = y[:,None] - y0
+    cell_dist = np.hypot(dx, dy)
+    ray_idx = np.rint(np.arctan2(dx, dy)*num_rays/(2*np.pi)).astype(int) % num_rays
+    step_idx = np.clip(np.rint(cell_dist/cellsize).astype(int) - 1, 0, num_steps-1)
+    visible = ray_visible[ray_idx,step_idx]
+    visible[cell_dist<cellsize] = True
+    visible[cell_dist>radius] = False
+    visible[np.isnan(z)] = False
+    return x, y, visible
+
+if __name__=='__main__':
+    import time
+    from terrain import TerrainTileCollection
+    tile_cltn = TerrainTileCollection('map_data/Download_llanbedr_terrain_2297518')
+    x_samp, y_samp = 258000, 322000
+    obs_asl = tile_cltn.lookup(x_samp, y_samp) + 50.0
+    start_time = time.time()
+    x_vis, y_vis, vis = viewshed(tile_cltn, x_samp, y_samp, obs_asl, 2000.0)
+    print(f'Viewshed of {vis.shape} took {time.time()-start_time:.3f}s, {vis.mean()*100:.0f}% visible')